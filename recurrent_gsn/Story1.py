@@ -11,7 +11,8 @@ import time
 from utils import data_tools as data
 from utils.logger import Logger
 from utils.utils import cast32, trunc, logit, get_shared_weights, get_shared_bias, get_shared_regression_weights, add_gaussian_noise, salt_and_pepper, load_from_config, fix_input_size, init_empty_file,\
-    make_time_units_string
+    make_time_units_string, sample_chains
+from utils.prefetch import Prefetcher, minibatches
 
 def experiment(state, outdir_base='./'):
     rng.seed(1) #seed the numpy random generator
@@ -585,6 +586,14 @@ def experiment(state, outdir_base='./'):
 
         return numpy.vstack(visible_chain), numpy.vstack(noisy_h0_chain)
     
+    def sample_many_chains(n_chains=100, n_steps=100, burn_in=100, thin=1):
+        # run independent chains together as rows of one minibatch through f_sample2,
+        # each one started from a different random test example
+        test_data = test_X.get_value(borrow=True)
+        rows = numpy.random.choice(len(test_data), n_chains, replace=(n_chains > len(test_data)))
+        init_vis = test_data[rows]
+        return sample_chains(f_sample2, f_noise, init_vis, [len(b.get_value()) for b in bias_list[1:]], n_chains, n_steps, burn_in, thin)
+    
     def plot_samples(epoch_number, iteration):
         to_sample = time.time()
         if layers == 1:
@@ -624,12 +633,21 @@ def experiment(state, outdir_base='./'):
     ################
     # GSN TRAINING #
     ################
+    def sequence_windows(dataset, batch_size):
+        # the len(Xs) shifted windows of every minibatch, trimmed to the same size
+        for i in range(len(dataset.get_value(borrow=True)) / batch_size):
+            xs = [dataset.get_value(borrow=True)[(i * batch_size) + sequence_idx : ((i+1) * batch_size) + sequence_idx] for sequence_idx in range(len(Xs))]
+            xs, _ = fix_input_size(xs)
+            yield xs
+    
     def train_GSN(iteration, train_X, train_Y, valid_X, valid_Y, test_X, test_Y):
         logger.log('----------------TRAINING GSN FOR ITERATION '+str(iteration)+"--------------\n")
         
         # TRAINING
         n_epoch     =   state.n_epoch
         batch_size  =   state.batch_size
+        # configs saved before the prefetch option don't have it
+        prefetch    =   getattr(state, 'prefetch', 2)
         STOP        =   False
         counter     =   0
         if iteration == 0:
@@ -664,16 +682,16 @@ def experiment(state, outdir_base='./'):
             #train
             train_costs = []
             train_errors= []
+            # the next minibatches are sliced in a background thread while the current one trains
             if iteration == 0:
-                for i in range(len(train_X.get_value(borrow=True)) / batch_size):
-                    x = train_X.get_value(borrow=True)[i * batch_size : (i+1) * batch_size]
+                train_batches = Prefetcher(minibatches(train_X, batch_size), prefetch)
+                for x in train_batches:
                     cost, error = gsn_f_learn_init(x)
                     train_costs.append([cost])
                     train_errors.append([error])
             else:
-                for i in range(len(train_X.get_value(borrow=True)) / batch_size):
-                    xs = [train_X.get_value(borrow=True)[(i * batch_size) + sequence_idx : ((i+1) * batch_size) + sequence_idx] for sequence_idx in range(len(Xs))]
-                    xs, _ = fix_input_size(xs)
+                train_batches = Prefetcher(sequence_windows(train_X, batch_size), prefetch)
+                for xs in train_batches:
                     _ins = xs #+ [sequence_window_size]
                     cost, error = gsn_f_learn(*_ins)
                     train_costs.append(cost)
@@ -682,6 +700,7 @@ def experiment(state, outdir_base='./'):
             train_costs = numpy.mean(train_costs) 
             train_errors = numpy.mean(train_errors)
             logger.append(['Train: ',trunc(train_costs),trunc(train_errors), '\t'])
+            logger.append(['data wait: ',make_time_units_string(train_batches.wait_time), '\t'])
             with open(train_convergence,'a') as f:
                 f.write("{0!s},".format(train_costs))
                 f.write("\n")
@@ -810,7 +829,7 @@ def experiment(state, outdir_base='./'):
         
         # 10k samples
         logger.log('Generating 10,000 samples')
-        samples, _  =   sample_some_numbers(N=10000)
+        samples     =   sample_many_chains(n_chains=100, n_steps=100, burn_in=100).reshape((-1, N_input))
         f_samples   =   outdir+'samples.npy'
         numpy.save(f_samples, samples)
         logger.log('saved digits')
@@ -576,6 +576,14 @@ def experiment(state, outdir_base='./'):
 
         return numpy.vstack(visible_chain), numpy.vstack(noisy_h0_chain)
     
+    def sample_many_chains(n_chains=100, n_steps=100, burn_in=100, thin=1):
+        # run independent chains together as rows of one minibatch through f_sample2,
+        # each one started from a different random test example
+        test_data = test_X.get_value(borrow=True)
+        rows = numpy.random.choice(len(test_data), n_chains, replace=(n_chains > len(test_data)))
+        init_vis = test_data[rows]
+        return sample_chains(f_sample2, f_noise, init_vis, [len(b.get_value()) for b in bias_list[1:]], n_chains, n_steps, burn_in, thin)
+    
     def plot_samples(epoch_number, iteration):
         to_sample = time.time()
         if layers == 1:
@@ -855,7 +863,7 @@ def experiment(state, outdir_base='./'):
     
         # 10k samples
         print 'Generating 10,000 samples'
-        samples, _  =   sample_some_numbers(N=10000)
+        samples     =   sample_many_chains(n_chains=100, n_steps=100, burn_in=100).reshape((-1, N_input))
         f_samples   =   outdir+'samples.npy'
         numpy.save(f_samples, samples)
         print 'saved digits'
@@ -1076,7 +1084,7 @@ def experiment(state, outdir_base='./'):
     
         # 10k samples
         print 'Generating 10,000 samples'
-        samples, _  =   sample_some_numbers(N=10000)
+        samples     =   sample_many_chains(n_chains=100, n_steps=100, burn_in=100).reshape((-1, N_input))
         f_samples   =   outdir+'samples.npy'
         numpy.save(f_samples, samples)
         print 'saved digits'
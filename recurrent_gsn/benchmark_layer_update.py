@@ -0,0 +1,61 @@
+'''
+Times the GSN layer updates with and without the fused in-between layer update (one GEMM over the stacked
+neighbours [h_(i+1), h_(i-1)] and weight blocks [W_i.T ; W_(i-1)]), for the theano graph and the numpy engine.
+'''
+import argparse
+import time
+
+import numpy
+import theano
+import theano.tensor as T
+
+from generative_stochastic_network import GSN, FusedWeights
+from numpy_gsn import NumpyGSN
+from utils.utils import get_shared_weights, get_shared_bias, make_time_units_string
+
+
+def time_function(f, args, repeats):
+    # first call includes any lazy allocation - don't count it
+    f(*args)
+    t = time.time()
+    for _ in xrange(repeats):
+        f(*args)
+    return (time.time() - t) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layers', type=int, default=3)
+    parser.add_argument('--walkbacks', type=int, default=5)
+    parser.add_argument('--hidden_sizes', type=str, default='1000,1500')
+    parser.add_argument('--input_size', type=int, default=784)
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    X_data = numpy.random.RandomState(1).binomial(n=1, p=0.2, size=(args.batch_size, args.input_size)).astype('float32')
+    X = T.fmatrix('X')
+
+    for hidden_size in [int(h) for h in args.hidden_sizes.split(',')]:
+        layer_sizes = [args.input_size] + [hidden_size] * args.layers
+        weights_list = [get_shared_weights(layer_sizes[i], layer_sizes[i+1], name="W_{0!s}_{1!s}".format(i,i+1)) for i in range(args.layers)]
+        bias_list    = [get_shared_bias(layer_sizes[i], name='b_'+str(i)) for i in range(args.layers + 1)]
+
+        times = {}
+        for fused in [False, True]:
+            walkback_weights = FusedWeights(weights_list) if fused else weights_list
+            p_X_chain, _ = GSN.build_gsn(X, walkback_weights, bias_list, add_noise=False, walkbacks=args.walkbacks)
+            f = theano.function(inputs=[X], outputs=p_X_chain[-1])
+            times[('theano', fused)] = time_function(f, [X_data], args.repeats)
+
+            numpy_gsn = NumpyGSN(weights_list, bias_list, fused=fused)
+            times[('numpy', fused)] = time_function(numpy_gsn.denoise, [X_data, args.walkbacks], args.repeats)
+
+        for engine in ['theano', 'numpy']:
+            separate, fused = times[(engine, False)], times[(engine, True)]
+            print "hidden_size {0!s}, {1!s} layers, {2!s}: separate {3!s}, fused {4!s} ({5:.2f}x)".format(
+                hidden_size, args.layers, engine, make_time_units_string(separate), make_time_units_string(fused), separate / fused)
+
+
+if __name__ == '__main__':
+    main()
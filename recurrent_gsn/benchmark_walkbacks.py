@@ -0,0 +1,44 @@
+'''
+Times building and compiling the GSN training cost for a growing number of walkbacks, with the walkbacks
+unrolled in the graph and inside one theano.scan (GSN.build_gsn_scan), to check how compile time scales.
+'''
+import argparse
+import time
+
+import theano
+import theano.tensor as T
+
+from generative_stochastic_network import GSN
+from utils.utils import get_shared_weights, get_shared_bias, make_time_units_string
+
+
+def compile_time(X, weights_list, bias_list, walkbacks, unroll):
+    t = time.time()
+    _, cost, show_cost, updates = GSN.build_gsn_scan(X, weights_list, bias_list, add_noise=True, walkbacks=walkbacks, unroll=unroll)
+    gradient = T.grad(cost, weights_list + bias_list)
+    theano.function(inputs=[X], outputs=[show_cost] + gradient, updates=updates)
+    return time.time() - t
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layers', type=int, default=3)
+    parser.add_argument('--walkbacks', type=str, default='1,2,5,10,20')
+    parser.add_argument('--hidden_size', type=int, default=500)
+    parser.add_argument('--input_size', type=int, default=784)
+    args = parser.parse_args()
+
+    X = T.fmatrix('X')
+    layer_sizes = [args.input_size] + [args.hidden_size] * args.layers
+    weights_list = [get_shared_weights(layer_sizes[i], layer_sizes[i+1], name="W_{0!s}_{1!s}".format(i,i+1)) for i in range(args.layers)]
+    bias_list    = [get_shared_bias(layer_sizes[i], name='b_'+str(i)) for i in range(args.layers + 1)]
+
+    for walkbacks in [int(w) for w in args.walkbacks.split(',')]:
+        unrolled = compile_time(X, weights_list, bias_list, walkbacks, True)
+        scanned  = compile_time(X, weights_list, bias_list, walkbacks, False)
+        print "{0!s} layers, {1!s} walkbacks: build+compile unrolled {2!s}, scan {3!s}".format(
+            args.layers, walkbacks, make_time_units_string(unrolled), make_time_units_string(scanned))
+
+
+if __name__ == '__main__':
+    main()
@@ -70,6 +70,18 @@ _defaults = {# gsn parameters
             "vis_init": False}
 
 
+class FusedWeights(list):
+    '''
+    A weights_list for the GSN layer updates that also holds, for every intermediate layer i, the block matrix
+    [W_i.T ; W_(i-1)]. With it, simple_update_layer computes the intermediate layers as one larger GEMM of the
+    concatenated neighbour activations [h_(i+1), h_(i-1)] instead of two GEMMs plus an add.
+    The blocks only depend on the weights, so theano computes them once per function call, not per walkback.
+    '''
+    def __init__(self, weights_list):
+        list.__init__(self, weights_list)
+        self.stacked = [None] + [T.concatenate([weights_list[i].T, weights_list[i-1]], axis=0) for i in range(1, len(weights_list))]
+
+
 class GSN():
     '''
     Class for creating a new Generative Stochastic Network (GSN)
@@ -215,6 +227,9 @@ class GSN():
         # If the top layer
         elif i == len(hiddens)-1:
             hiddens[i] = T.dot(hiddens[i-1], weights_list[i-1]) + bias_list[i]
+        # Fused in-between layers: one GEMM over the stacked neighbours and weight blocks
+        elif isinstance(weights_list, FusedWeights):
+            hiddens[i] = T.dot(T.concatenate([hiddens[i+1], hiddens[i-1]], axis=1), weights_list.stacked[i]) + bias_list[i]
         # Otherwise in-between layers
         else:
             # next layer        :   hiddens[i+1], assigned weights : W_i
@@ -258,6 +273,79 @@ class GSN():
 
 
 
+    #############################
+    #   THE WALKBACK BUILDER    #
+    #############################
+    @staticmethod
+    def build_walkbacks(hiddens,
+                        weights_list,
+                        bias_list,
+                        add_noise              = _defaults["add_noise"],
+                        noiseless_h1           = _defaults["noiseless_h1"],
+                        hidden_add_noise_sigma = _defaults["hidden_add_noise_sigma"],
+                        input_salt_and_pepper  = _defaults["input_salt_and_pepper"],
+                        input_sampling         = _defaults["input_sampling"],
+                        MRG                    = _defaults["MRG"],
+                        visible_activation     = _defaults["visible_activation"],
+                        hidden_activation      = _defaults["hidden_activation"],
+                        walkbacks              = _defaults["walkbacks"],
+                        reverse                = False,
+                        unroll                 = True,
+                        updates                = None):
+        """
+        Runs k walkbacks of the layer update scheme starting from the given hiddens.
+        Like update_layers, the hiddens list is modified inplace to hold the final layer values.
+
+        With unroll, walkbacks x layers copies of the layer update are put in the graph, so graph size and
+        compile time grow linearly with walkbacks. Otherwise a theano.scan carries the hiddens list through
+        the walkbacks and emits the p(X|...) chain as one stacked tensor, keeping the graph size flat.
+
+        @type  hiddens: List(Theano symbolic variable)
+        @param hiddens: The initial layer values [X, H1, H2, ...].
+
+        @type  reverse: Boolean
+        @param reverse: Whether to update the even layers before the odd layers (update_layers_reverse).
+
+        @type  unroll: Boolean
+        @param unroll: Whether to unroll the walkbacks with a python loop instead of using theano.scan.
+
+        @type  updates: OrderedDict
+        @param updates: When using scan, the random number generator updates from the scan are added to this
+                        dictionary. They have to be given to theano.function.
+
+        @rtype:   List
+        @return:  predicted_x_chain - with scan, these are the entries of the stacked scan output
+        """
+        update = GSN.update_layers_reverse if reverse else GSN.update_layers
+        noise_args = (add_noise, noiseless_h1, hidden_add_noise_sigma, input_salt_and_pepper, input_sampling, MRG, visible_activation, hidden_activation)
+
+        if unroll:
+            p_X_chain = []
+            for i in range(walkbacks):
+                update(hiddens, weights_list, bias_list, p_X_chain, *noise_args)
+            return p_X_chain
+
+        if updates is None:
+            raise AssertionError("Please provide an updates dictionary to collect the random number updates from the walkback scan.")
+
+        n_hiddens = len(hiddens)
+        def walkback_step(*args):
+            hiddens_t = list(args[:n_hiddens])
+            p_X_chain_t = []
+            update(hiddens_t, weights_list, bias_list, p_X_chain_t, *noise_args)
+            return [p_X_chain_t[-1]] + hiddens_t
+
+        outputs, scan_updates = theano.scan(fn=walkback_step,
+                                            outputs_info=[None] + list(hiddens),
+                                            non_sequences=list(weights_list) + bias_list + [w for w in getattr(weights_list, 'stacked', []) if w is not None],
+                                            n_steps=walkbacks)
+        updates.update(scan_updates)
+        # set the final layer values inplace, just like the unrolled updates do
+        hiddens[:] = [h[-1] for h in outputs[1:]]
+        p_X_stacked = outputs[0]
+        return [p_X_stacked[i] for i in range(walkbacks)]
+
+
     ############################
     #   THE MAIN GSN BUILDER   #
     ############################
@@ -273,7 +361,9 @@ class GSN():
                   MRG                    = _defaults["MRG"],
                   visible_activation     = _defaults["visible_activation"],
                   hidden_activation      = _defaults["hidden_activation"],
-                  walkbacks              = _defaults["walkbacks"]):
+                  walkbacks              = _defaults["walkbacks"],
+                  unroll                 = True,
+                  updates                = None):
         """
         Construct a GSN (unimodal transition operator) for k walkbacks on the input X.
         Returns the list of predicted X's after k walkbacks and the resulting layer values.
@@ -314,13 +404,15 @@ class GSN():
         @type  walkbacks: Integer
         @param walkbacks: The k number of walkbacks to use for the GSN.
 
-        @type  logger: Logger
-        @param logger: The output log to use.
+        @type  unroll: Boolean
+        @param unroll: Whether to unroll the walkbacks in python or use theano.scan (see build_walkbacks).
+
+        @type  updates: OrderedDict
+        @param updates: Collects the random number updates when using scan.
 
         @rtype:   List
         @return:  predicted_x_chain, hiddens
         """
-        p_X_chain = []
         # Whether or not to corrupt the visible input X
         if add_noise:
             X_init = salt_and_pepper(X, input_salt_and_pepper, MRG)
@@ -331,8 +423,7 @@ class GSN():
         for w in weights_list:
             hiddens.append(T.zeros_like(T.dot(hiddens[-1], w)))
         # The layer update scheme
-        for i in range(walkbacks):
-            GSN.update_layers(hiddens, weights_list, bias_list, p_X_chain, add_noise, noiseless_h1, hidden_add_noise_sigma, input_salt_and_pepper, input_sampling, MRG, visible_activation, hidden_activation)
+        p_X_chain = GSN.build_walkbacks(hiddens, weights_list, bias_list, add_noise, noiseless_h1, hidden_add_noise_sigma, input_salt_and_pepper, input_sampling, MRG, visible_activation, hidden_activation, walkbacks, False, unroll, updates)
 
         return p_X_chain, hiddens
 
@@ -350,11 +441,11 @@ class GSN():
                                 visible_activation     = _defaults["visible_activation"],
                                 hidden_activation      = _defaults["hidden_activation"],
                                 walkbacks              = _defaults["walkbacks"],
-                                cost_function          = _defaults["cost_function"]):
+                                cost_function          = _defaults["cost_function"],
+                                unroll                 = True,
+                                updates                = None):
 
-        p_X_chain = []
-        for i in range(walkbacks):
-            GSN.update_layers_reverse(hiddens, weights_list, bias_list, p_X_chain, add_noise, noiseless_h1, hidden_add_noise_sigma, input_salt_and_pepper, input_sampling, MRG, visible_activation, hidden_activation)
+        p_X_chain = GSN.build_walkbacks(hiddens, weights_list, bias_list, add_noise, noiseless_h1, hidden_add_noise_sigma, input_salt_and_pepper, input_sampling, MRG, visible_activation, hidden_activation, walkbacks, True, unroll, updates)
 
         # x_sample = p_X_chain[-1]
 
@@ -380,8 +471,19 @@ class GSN():
                        visible_activation     = _defaults["visible_activation"],
                        hidden_activation      = _defaults["hidden_activation"],
                        walkbacks              = _defaults["walkbacks"],
-                       cost_function          = _defaults["cost_function"]):
+                       cost_function          = _defaults["cost_function"],
+                       unroll                 = False,
+                       updates                = None):
+        """
+        Construct a GSN for k walkbacks on the input X with the walkbacks in a theano.scan (unless unroll),
+        and the cost of the p(X|...) chain against X. The scan's random number updates go in updates
+        (a new OrderedDict if none is given), which is returned so it can be given to theano.function.
 
+        @rtype:   List
+        @return:  x_sample, cost, show_cost, updates
+        """
+        if updates is None:
+            updates = OrderedDict()
         # Whether or not to corrupt the visible input X
         if add_noise:
             X_init = salt_and_pepper(X, input_salt_and_pepper, MRG)
@@ -392,10 +494,7 @@ class GSN():
         for w in weights_list:
             hiddens_0.append(T.zeros_like(T.dot(hiddens_0[-1], w)))
 
-        p_X_chain = []
-        for i in range(walkbacks):
-            GSN.update_layers(hiddens_0, weights_list, bias_list, p_X_chain, add_noise, noiseless_h1, hidden_add_noise_sigma, input_salt_and_pepper, input_sampling, MRG, visible_activation, hidden_activation)
-
+        p_X_chain = GSN.build_walkbacks(hiddens_0, weights_list, bias_list, add_noise, noiseless_h1, hidden_add_noise_sigma, input_salt_and_pepper, input_sampling, MRG, visible_activation, hidden_activation, walkbacks, False, unroll, updates)
 
         x_sample = p_X_chain[-1]
 
@@ -403,7 +502,7 @@ class GSN():
         show_cost = costs[-1] # for logging to show progress
         cost      = numpy.sum(costs)
 
-        return x_sample, cost, show_cost#, updates
+        return x_sample, cost, show_cost, updates
 
     @staticmethod
     def build_gsn_pxh(hiddens,
@@ -417,11 +516,11 @@ class GSN():
                     MRG                    = _defaults["MRG"],
                     visible_activation     = _defaults["visible_activation"],
                     hidden_activation      = _defaults["hidden_activation"],
-                    walkbacks              = _defaults["walkbacks"]):
+                    walkbacks              = _defaults["walkbacks"],
+                    unroll                 = True,
+                    updates                = None):
 
-        p_X_chain = []
-        for i in range(walkbacks):
-            GSN.update_layers(hiddens, weights_list, bias_list, p_X_chain, add_noise, noiseless_h1, hidden_add_noise_sigma, input_salt_and_pepper, input_sampling, MRG, visible_activation, hidden_activation)
+        p_X_chain = GSN.build_walkbacks(hiddens, weights_list, bias_list, add_noise, noiseless_h1, hidden_add_noise_sigma, input_salt_and_pepper, input_sampling, MRG, visible_activation, hidden_activation, walkbacks, False, unroll, updates)
 
         x_sample = p_X_chain[-1]
 
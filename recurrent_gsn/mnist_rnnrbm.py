@@ -15,6 +15,7 @@ import PIL.Image
 from collections import OrderedDict
 from utils.image_tiler import *
 from utils import data_tools as data
+from utils.prefetch import Prefetcher, minibatches
 import random as R
 
 #Don't use a python long as this don't work on 32 bits computers.
@@ -251,7 +252,7 @@ lr : float
         print 'functions done.'
         print
 
-    def train(self, batch_size=100, num_epochs=300):
+    def train(self, batch_size=100, num_epochs=300, prefetch=2):
         '''Train the RNN-RBM via stochastic gradient descent (SGD) using MIDI
 files converted to piano-rolls.
 
@@ -262,7 +263,9 @@ batch_size : integer
   before applying the SGD updates.
 num_epochs : integer
   Number of epochs (pass over the training set) performed. The user can
-  safely interrupt training with Ctrl+C at any time.'''
+  safely interrupt training with Ctrl+C at any time.
+prefetch : integer
+  Number of minibatches prepared in a background thread ahead of the SGD step.'''
 
 
         (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = data.load_mnist("../datasets/")
@@ -305,19 +308,18 @@ num_epochs : integer
                 tests = []
                 test_acc = []
 
-                for i in range(len(train_X.get_value(borrow=True)) / batch_size):
-                    t0=time.time()
-                    xs = train_X.get_value(borrow=True)[(i * batch_size) : ((i+1) * batch_size)]
+                train_batches = Prefetcher(minibatches(train_X, batch_size), prefetch)
+                for xs in train_batches:
                     acc, cost, cross = self.train_function(xs)
                     accuracy.append(acc)
                     costs.append(cost)
                     crossentropy.append(cross)
-                    print time.time()-t0
                     
                 print 'Train',numpy.mean(accuracy), 'cost', numpy.mean(costs), 'cross', numpy.mean(crossentropy),
+                print 'data wait', trunc(train_batches.wait_time),
                     
-                for i in range(len(test_X.get_value(borrow=True)) / batch_size):
-                    xs = train_X.get_value(borrow=True)[(i * batch_size) : ((i+1) * batch_size)]
+                # (evaluates on the first len(test_X) training examples, as before)
+                for xs in Prefetcher(minibatches(train_X.get_value(borrow=True)[:len(test_X.get_value(borrow=True))], batch_size), prefetch):
                     acc, cost = self.test_function(xs)
                     test_acc.append(acc)
                     tests.append(cost)
@@ -0,0 +1,237 @@
+'''
+.. module: numpy_gsn
+
+A Theano-free NumPy execution path for trained Generative Stochastic Networks.
+
+This mirrors the layer update scheme in generative_stochastic_network.GSN (odd layers, then even layers,
+with gaussian hidden noise and salt-and-pepper input corruption) but runs directly on numpy arrays with
+BLAS-backed numpy.dot calls. No theano.function is compiled, so processes that only want to denoise or
+sample from a saved *_params_epoch_*.pkl file can start producing samples immediately.
+'''
+__authors__ = "Markus Beissinger"
+__copyright__ = "Copyright 2015, Vitruvian Science"
+__credits__ = ["Markus Beissinger", "Li Yao"]
+__license__ = "Apache"
+__maintainer__ = "OpenDeep"
+__email__ = "dev@opendeep.org"
+
+# standard libraries
+import cPickle
+import time
+# third-party libraries
+import numpy
+# internal references
+import utils.logger as log
+from utils.utils import get_numpy_activation_function, make_time_units_string
+
+# Default values match the _defaults of generative_stochastic_network.
+_defaults = {"walkbacks": 5,
+             "visible_activation": 'sigmoid',
+             "hidden_activation": 'tanh',
+             "input_sampling": True,
+             "noiseless_h1": True,
+             "hidden_add_noise_sigma": 2,
+             "input_salt_and_pepper": 0.4}
+
+
+def _as_array(param):
+    # accept theano shared variables (from the pickled parameter files) as well as plain arrays
+    if hasattr(param, 'get_value'):
+        param = param.get_value(borrow=True)
+    return numpy.asarray(param, dtype='float32')
+
+def _as_float(value):
+    # noise levels are often theano shared variables so they can be annealed
+    if hasattr(value, 'get_value'):
+        value = value.get_value()
+    return float(value)
+
+
+class NumpyGSN():
+    '''
+    Runs the GSN walkback chain with numpy, given trained weights and biases.
+    '''
+    def __init__(self, weights_list, bias_list,
+                 visible_activation     = _defaults["visible_activation"],
+                 hidden_activation      = _defaults["hidden_activation"],
+                 noiseless_h1           = _defaults["noiseless_h1"],
+                 hidden_add_noise_sigma = _defaults["hidden_add_noise_sigma"],
+                 input_salt_and_pepper  = _defaults["input_salt_and_pepper"],
+                 input_sampling         = _defaults["input_sampling"],
+                 fused=False, rng=None, logger=None):
+        """
+        @type  weights_list: List(matrix)
+        @param weights_list: The weights between layers (numpy arrays or theano shared variables).
+
+        @type  bias_list: List(vector)
+        @param bias_list: The biases for each layer (numpy arrays or theano shared variables).
+
+        @type  visible_activation: String or Function
+        @param visible_activation: Name of the visible activation ('sigmoid', 'tanh', 'rectifier') or a numpy function.
+
+        @type  hidden_activation: String or Function
+        @param hidden_activation: Name of the hidden activation ('sigmoid', 'tanh', 'rectifier') or a numpy function.
+
+        @type  fused: Boolean
+        @param fused: Whether to update the in-between layers with one GEMM over the stacked neighbours [h_(i+1), h_(i-1)]
+        and weight blocks [W_i.T ; W_(i-1)] instead of two GEMMs plus an add.
+
+        @type  rng: numpy.random.RandomState
+        @param rng: Random generator for the noise and sampling.
+        """
+        self.logger = logger
+        self.weights_list = [_as_array(w) for w in weights_list]
+        self.bias_list    = [_as_array(b) for b in bias_list]
+        # keep the transposes around so the downward pass doesn't transpose on every call
+        self.weights_list_T = [numpy.ascontiguousarray(w.T) for w in self.weights_list]
+        self.fused = fused
+        if self.fused:
+            self.stacked_weights = [None] + [numpy.vstack([self.weights_list_T[i], self.weights_list[i-1]])
+                                             for i in range(1, len(self.weights_list))]
+
+        if isinstance(visible_activation, basestring):
+            visible_activation = get_numpy_activation_function(visible_activation)
+        if isinstance(hidden_activation, basestring):
+            hidden_activation = get_numpy_activation_function(hidden_activation)
+        self.visible_activation = visible_activation
+        self.hidden_activation  = hidden_activation
+
+        self.noiseless_h1           = noiseless_h1
+        self.hidden_add_noise_sigma = _as_float(hidden_add_noise_sigma)
+        self.input_salt_and_pepper  = _as_float(input_salt_and_pepper)
+        self.input_sampling         = input_sampling
+
+        if rng is None:
+            rng = numpy.random.RandomState(1)
+        self.rng = rng
+
+    @staticmethod
+    def load(filename, layers, **kwargs):
+        '''
+        Creates a NumpyGSN from a pickled parameter file. The file is expected to start with
+        weights_list + bias_list, which is the layout GSN and RNN_GSN save their parameters in.
+        '''
+        with open(filename, 'rb') as f:
+            loaded_params = cPickle.load(f)
+        weights_list = loaded_params[:layers]
+        bias_list    = loaded_params[layers:2*layers+1]
+        return NumpyGSN(weights_list, bias_list, **kwargs)
+
+    ##################
+    # NOISE HELPERS  #
+    ##################
+    def add_gaussian_noise(self, IN, std):
+        return IN + self.rng.normal(loc=0, scale=std, size=IN.shape).astype('float32')
+
+    def salt_and_pepper(self, IN, p):
+        # same single-draw corruption as utils.salt_and_pepper
+        u = self.rng.uniform(size=IN.shape)
+        return IN * (u >= p) + (u < p / 2.)
+
+    ##################
+    # LAYER UPDATES  #
+    ##################
+    def update_layers(self, hiddens, p_X_chain, add_noise=True):
+        # One update over the odd layers + one update over the even layers
+        self.update_odd_layers(hiddens, add_noise)
+        self.update_even_layers(hiddens, p_X_chain, add_noise)
+
+    def update_layers_reverse(self, hiddens, p_X_chain, add_noise=True):
+        # One update over the even layers + one update over the odd layers
+        self.update_even_layers(hiddens, p_X_chain, add_noise)
+        self.update_odd_layers(hiddens, add_noise)
+
+    def update_odd_layers(self, hiddens, add_noise=True):
+        for i in range(1, len(hiddens), 2):
+            self.simple_update_layer(hiddens, None, i, add_noise)
+
+    def update_even_layers(self, hiddens, p_X_chain, add_noise=True):
+        for i in range(0, len(hiddens), 2):
+            self.simple_update_layer(hiddens, p_X_chain, i, add_noise)
+
+    def simple_update_layer(self, hiddens, p_X_chain, i, add_noise=True):
+        '''
+        Numpy version of GSN.simple_update_layer - modifies hiddens inplace and appends to p_X_chain when i == 0.
+        '''
+        # If the visible layer X
+        if i == 0:
+            hiddens[i] = numpy.dot(hiddens[i+1], self.weights_list_T[i]) + self.bias_list[i]
+        # If the top layer
+        elif i == len(hiddens)-1:
+            hiddens[i] = numpy.dot(hiddens[i-1], self.weights_list[i-1]) + self.bias_list[i]
+        # Fused in-between layers: one GEMM over the stacked neighbours and weight blocks
+        elif self.fused:
+            hiddens[i] = numpy.dot(numpy.hstack([hiddens[i+1], hiddens[i-1]]), self.stacked_weights[i]) + self.bias_list[i]
+        # Otherwise in-between layers
+        else:
+            hiddens[i] = numpy.dot(hiddens[i+1], self.weights_list_T[i]) + numpy.dot(hiddens[i-1], self.weights_list[i-1]) + self.bias_list[i]
+
+        if i == 1 and self.noiseless_h1:
+            add_noise = False
+
+        # pre activation noise
+        if i != 0 and add_noise:
+            hiddens[i] = self.add_gaussian_noise(hiddens[i], self.hidden_add_noise_sigma)
+
+        # ACTIVATION!
+        if i == 0:
+            hiddens[i] = self.visible_activation(hiddens[i])
+        else:
+            hiddens[i] = self.hidden_activation(hiddens[i])
+
+        # post activation noise
+        if i != 0 and add_noise:
+            hiddens[i] = self.add_gaussian_noise(hiddens[i], self.hidden_add_noise_sigma)
+
+        # build the reconstruction chain if updating the visible layer X
+        if i == 0:
+            p_X_chain.append(hiddens[i])
+            if self.input_sampling:
+                sampled = self.rng.binomial(n=1, p=hiddens[i], size=hiddens[i].shape).astype('float32')
+            else:
+                sampled = hiddens[i]
+            hiddens[i] = self.salt_and_pepper(sampled, self.input_salt_and_pepper)
+
+    ############################
+    #   CHAIN HELPERS          #
+    ############################
+    def init_hiddens(self, X):
+        return [X] + [numpy.zeros((X.shape[0], w.shape[1]), dtype='float32') for w in self.weights_list]
+
+    def build_gsn(self, X, walkbacks=_defaults["walkbacks"], add_noise=True):
+        """
+        Numpy counterpart of GSN.build_gsn: runs k walkbacks on the input X.
+
+        @rtype:   List
+        @return:  predicted_x_chain, hiddens
+        """
+        X = numpy.asarray(X, dtype='float32')
+        if add_noise:
+            X = self.salt_and_pepper(X, self.input_salt_and_pepper)
+        hiddens = self.init_hiddens(X)
+        p_X_chain = []
+        for _ in range(walkbacks):
+            self.update_layers(hiddens, p_X_chain, add_noise)
+        return p_X_chain, hiddens
+
+    def denoise(self, X, walkbacks=_defaults["walkbacks"]):
+        p_X_chain, _ = self.build_gsn(X, walkbacks, add_noise=False)
+        return p_X_chain[-1]
+
+    def sample(self, initial, n_samples=400, k=1):
+        '''
+        Runs the sampling chain from the initial visible state. Mirrors RNN_GSN.sample - returns the
+        visible expectation chain and the hiddens taken every k steps.
+        '''
+        log.maybeLog(self.logger, "Starting numpy sampling...")
+        _t = time.time()
+        init_vis = numpy.asarray(initial, dtype='float32')
+        network_state = self.init_hiddens(self.salt_and_pepper(init_vis, self.input_salt_and_pepper))
+        visible_chain = [init_vis]
+        sampled_h = []
+        for i in xrange(n_samples-1):
+            self.update_layers(network_state, visible_chain)
+            if i % k == 0:
+                sampled_h.append(list(network_state[1:]))
+        log.maybeLog(self.logger, "Sampling done, took "+make_time_units_string(time.time()-_t))
+        return numpy.vstack(visible_chain), sampled_h
@@ -22,10 +22,18 @@ import theano.tensor as T
 import theano.sandbox.rng_mrg as RNG_MRG
 
 from utils import data_tools as data
-from generative_stochastic_network import GSN
+from generative_stochastic_network import GSN, FusedWeights
+from numpy_gsn import NumpyGSN
 import utils.logger as log
+from utils.function_cache import FunctionCache
+from utils.lazy_functions import LazyFunctions
+from utils.prefetch import Prefetcher
 from utils.image_tiler import tile_raster_images
-from utils.utils import cast32, logit, trunc, get_shared_weights, get_shared_bias, salt_and_pepper, make_time_units_string, get_activation_function, get_cost_function, raise_to_list, closest_to_square_factors, copy_params, restore_params
+from utils.utils import cast32, logit, trunc, get_shared_weights, get_shared_bias, salt_and_pepper, make_time_units_string, get_activation_function, get_cost_function, raise_to_list, closest_to_square_factors, copy_params, restore_params, sample_chains
+
+# The names of the theano activation functions that have numpy counterparts (for get_numpy_gsn)
+_activation_names = {T.nnet.sigmoid: 'sigmoid',
+                     T.tanh: 'tanh'}
 
 # Default values to use for some RNN-GSN parameters
 defaults = {# gsn parameters
@@ -36,6 +44,12 @@ defaults = {# gsn parameters
             "visible_activation": lambda x: T.nnet.sigmoid(x),
             "input_sampling": True,
             "MRG": RNG_MRG.MRG_RandomStreams(1),
+            "unroll_walkbacks": False, # whether to unroll the walkbacks in the graph instead of using theano.scan
+            "cache_functions": False, # whether to keep the compiled functions in a cache under the output path
+            "fused_layer_update": False, # whether to update the in-between GSN layers with one GEMM over both neighbours
+            "prefetch": 2, # number of padded sequence batches to prepare in a background thread ahead of training on them
+            "sequences_per_batch": 1, # train on padded, masked batches of this many similar-length sequences when > 1
+            "truncated_bptt": False, # carry the recurrent state from one batch_size chunk of a sequence to the next (needs sequences_per_batch = 1)
             # recurrent parameters
             "recurrent_hidden_size": 1500,
             "recurrent_hidden_activation": lambda x: T.tanh(x),
@@ -65,7 +79,7 @@ defaults = {# gsn parameters
             "output_path": '../outputs/rnn_gsn/'}
 
 
-class RNN_GSN():
+class RNN_GSN(LazyFunctions):
     '''
     Class for creating a new Recurrent Generative Stochastic Network (RNN-GSN)
     '''
@@ -98,7 +112,7 @@ class RNN_GSN():
             if args.get("input_size") is None:
                 raise AssertionError("Please either specify input_size in the arguments or provide an example train_X for input dimensionality.")
         else:
-            self.N_input = self.train_X[0].get_value(borrow=True).shape[1]
+            self.N_input = data.dataset_shape(self.train_X[0])[1]
         
         self.is_image = args.get('is_image', defaults['is_image'])
         if self.is_image:
@@ -118,6 +132,12 @@ class RNN_GSN():
         self.noise_annealing = cast32(args.get('noise_annealing', defaults['noise_annealing'])) # exponential noise annealing coefficient
         self.batch_size      = args.get('batch_size', defaults['batch_size'])
         self.gsn_batch_size = args.get('gsn_batch_size', defaults['gsn_batch_size'])
+        self.prefetch       = args.get('prefetch', defaults['prefetch'])
+        self.sequences_per_batch = args.get('sequences_per_batch', defaults['sequences_per_batch'])
+        self.truncated_bptt = args.get('truncated_bptt', defaults['truncated_bptt'])
+        if self.truncated_bptt and self.sequences_per_batch > 1:
+            # the padded multi-sequence batches start every chunk from the zero state, there is no state to carry
+            raise ValueError("truncated_bptt only works with sequences_per_batch = 1, got sequences_per_batch = {0!s}".format(self.sequences_per_batch))
         self.n_epoch         = args.get('n_epoch', defaults['n_epoch'])
         self.early_stop_threshold = args.get('early_stop_threshold', defaults['early_stop_threshold'])
         self.early_stop_length = args.get('early_stop_length', defaults['early_stop_length'])
@@ -130,25 +150,27 @@ class RNN_GSN():
         self.vis_init               = args.get('vis_init', defaults['vis_init'])
         self.initialize_gsn         = args.get('initialize_gsn', defaults['initialize_gsn'])
         self.hessian_free           = args.get('hessian_free', defaults['hessian_free'])
+        self.unroll_walkbacks       = args.get('unroll_walkbacks', defaults['unroll_walkbacks'])
+        self.fused_layer_update     = args.get('fused_layer_update', defaults['fused_layer_update'])
         
         self.hidden_size = args.get('hidden_size', defaults['hidden_size'])
         self.layer_sizes = [self.N_input] + [self.hidden_size] * self.layers # layer sizes, from h0 to hK (h0 is the visible layer)
         self.recurrent_hidden_size = args.get('recurrent_hidden_size', defaults['recurrent_hidden_size'])
         
-        self.f_recon = None
-        self.f_noise = None
-        
         # Activation functions!
         # For the GSN:
         if args.get('hidden_activation') is not None:
             log.maybeLog(self.logger, 'Using specified activation for GSN hiddens')
             self.hidden_activation = args.get('hidden_activation')
+            self.hidden_act = _activation_names.get(self.hidden_activation)
         elif args.get('hidden_act') is not None:
             self.hidden_activation = get_activation_function(args.get('hidden_act'))
+            self.hidden_act = args.get('hidden_act')
             log.maybeLog(self.logger, 'Using {0!s} activation for GSN hiddens'.format(args.get('hidden_act')))
         else:
             log.maybeLog(self.logger, "Using default activation for GSN hiddens")
             self.hidden_activation = defaults['hidden_activation']
+            self.hidden_act = 'tanh'
             
         # For the RNN:
         if args.get('recurrent_hidden_activation') is not None:
@@ -165,12 +187,15 @@ class RNN_GSN():
         if args.get('visible_activation') is not None:
             log.maybeLog(self.logger, 'Using specified activation for visible layer')
             self.visible_activation = args.get('visible_activation')
+            self.visible_act = _activation_names.get(self.visible_activation)
         elif args.get('visible_act') is not None:
             self.visible_activation = get_activation_function(args.get('visible_act'))
+            self.visible_act = args.get('visible_act')
             log.maybeLog(self.logger, 'Using {0!s} activation for visible layer'.format(args.get('visible_act')))
         else:
             log.maybeLog(self.logger, 'Using default activation for visible layer')
             self.visible_activation = defaults['visible_activation']
+            self.visible_act = 'sigmoid'
             
         # Cost function!
         if args.get('cost_function') is not None:
@@ -183,12 +208,46 @@ class RNN_GSN():
             log.maybeLog(self.logger, '\nUsing default cost function for GSN training\n')
             self.cost_function = defaults['cost_function']
         
+        # Compiled function cache - keyed by everything that changes the graphs.
+        # Custom activation or cost callables can't be part of the key, so don't cache with them.
+        self.function_cache = None
+        if args.get('cache_functions', defaults['cache_functions']):
+            custom_functions = [name for name in ('hidden_activation', 'recurrent_hidden_activation', 'visible_activation', 'cost_function') if args.get(name) is not None]
+            if custom_functions:
+                log.maybeLog(self.logger, "Not caching compiled functions because of specified {0!s}".format(', '.join(custom_functions)))
+            else:
+                cache_config = {'model':                 'rnngsn',
+                                'input_size':            self.N_input,
+                                'layers':                self.layers,
+                                'walkbacks':             self.walkbacks,
+                                'batch_size':            self.batch_size,
+                                'hidden_size':           self.hidden_size,
+                                'recurrent_hidden_size': self.recurrent_hidden_size,
+                                'hidden_act':            args.get('hidden_act'),
+                                'recurrent_hidden_act':  args.get('recurrent_hidden_act'),
+                                'visible_act':           args.get('visible_act'),
+                                'cost_funct':            args.get('cost_funct'),
+                                'noiseless_h1':          self.noiseless_h1,
+                                'input_sampling':        self.input_sampling,
+                                'hessian_free':          self.hessian_free,
+                                'unroll_walkbacks':      self.unroll_walkbacks,
+                                'fused_layer_update':    self.fused_layer_update,
+                                'truncated_bptt':        self.truncated_bptt}
+                # data_buffer holds the dataset, which is left out of the cached functions
+                self.function_cache = FunctionCache(self.outdir+'function_cache/', cache_config, self.logger, data_names=['data_buffer'])
+        
         ############################
         # Theano variables and RNG #
         ############################
         self.X = T.fmatrix('X') #single (batch) for training gsn
         self.Xs = T.fmatrix('Xs') #sequence for training rnn-gsn
         self.MRG = RNG_MRG.MRG_RandomStreams(1)
+        # the training functions take the offset of a sequence in data_buffer and a minibatch index into it,
+        # and slice the minibatch from the buffer through givens
+        self.offset = T.lscalar('offset')
+        self.index = T.lscalar('index')
+        self.data_buffer = theano.shared(numpy.zeros((self.batch_size, self.N_input), dtype='float32'), name='data_buffer')
+        self.batch_givens = {self.Xs: self.data_buffer[self.offset + self.index*self.batch_size : self.offset + (self.index+1)*self.batch_size]}
         
         ###############
         # Parameters! #
@@ -196,6 +255,8 @@ class RNN_GSN():
         #gsn
         self.weights_list = [get_shared_weights(self.layer_sizes[i], self.layer_sizes[i+1], name="W_{0!s}_{1!s}".format(i,i+1)) for i in range(self.layers)] # initialize each layer to uniform sample from sqrt(6. / (n_in + n_out))
         self.bias_list    = [get_shared_bias(self.layer_sizes[i], name='b_'+str(i)) for i in range(self.layers + 1)] # initialize each layer to 0's.
+        # the weights the GSN layer updates use - same parameters, optionally with the fused in-between layer blocks
+        self.walkback_weights_list = FusedWeights(self.weights_list) if self.fused_layer_update else self.weights_list
         
         #recurrent
         self.recurrent_to_gsn_weights_list = [get_shared_weights(self.recurrent_hidden_size, self.layer_sizes[layer], name="W_u_h{0!s}".format(layer)) for layer in range(self.layers+1) if layer%2 != 0]
@@ -266,7 +327,7 @@ class RNN_GSN():
         _add_noise = True
         log.maybeLog(self.logger, "Performing one walkback in network state sampling.")
         GSN.update_layers(self.network_state_output,
-                          self.weights_list,
+                          self.walkback_weights_list,
                           self.bias_list,
                           visible_pX_chain, 
                           _add_noise,
@@ -283,129 +344,331 @@ class RNN_GSN():
         #############################################
         #      Build the graphs for the RNN-GSN     #
         #############################################
-        # If `x_t` is given, deterministic recurrence to compute the u_t. Otherwise, first generate
-        def recurrent_step(x_t, u_tm1, add_noise):
-            # Make current guess for hiddens based on U
-            for i in range(self.layers):
-                if i%2 == 0:
-                    log.maybeLog(self.logger, "Using {0!s} and {1!s}".format(self.recurrent_to_gsn_weights_list[(i+1)/2],self.bias_list[i+1]))
-            h_t = T.concatenate([self.hidden_activation(self.bias_list[i+1] + T.dot(u_tm1, self.recurrent_to_gsn_weights_list[(i+1)/2])) for i in range(self.layers) if i%2 == 0],axis=0)
-            
-            generate = x_t is None
-            if generate:
-                pass
-            
-            # Make a GSN to update U
-    #         chain, hs = gsn.build_gsn(x_t, weights_list, bias_list, add_noise, state.noiseless_h1, state.hidden_add_noise_sigma, state.input_salt_and_pepper, state.input_sampling, MRG, visible_activation, hidden_activation, walkbacks, logger)
-    #         htop_t = hs[-1]
-    #         denoised_x_t = chain[-1]
-            # Update U
-    #         ua_t = T.dot(denoised_x_t, W_x_u) + T.dot(htop_t, W_h_u) + T.dot(u_tm1, W_u_u) + recurrent_bias
-            ua_t = T.dot(x_t, self.W_x_u) + T.dot(u_tm1, self.W_u_u) + self.recurrent_bias
+        # The input projection Xs . W_x_u doesn't depend on the recurrence, so compute it for the whole
+        # sequence as one GEMM before the scan. Only the u_tm1 . W_u_u term has to stay inside the loop.
+        x_u_projection = T.dot(self.Xs, self.W_x_u) + self.recurrent_bias
+        
+        # Deterministic recurrence to compute the u_t given the projected x_t.
+        def recurrent_step(xu_t, u_tm1):
+            ua_t = xu_t + T.dot(u_tm1, self.W_u_u)
             u_t = self.recurrent_hidden_activation(ua_t)
-            return None if generate else [ua_t, u_t, h_t]
+            return [ua_t, u_t]
+        
+        # Make the guess for the GSN hiddens at time t based on u_(t-1). The W_u_h projections are applied
+        # to the stacked u's after the scan instead of once per timestep inside it.
+        def recurrent_hiddens(u_tm1, X):
+            h_list = [T.zeros_like(X)]
+            for layer, w in enumerate(self.weights_list):
+                if layer%2 != 0:
+                    h_list.append(T.zeros_like(T.dot(h_list[-1], w)))
+                else:
+                    log.maybeLog(self.logger, "Using {0!s} and {1!s}".format(self.recurrent_to_gsn_weights_list[layer/2],self.bias_list[layer+1]))
+                    h_list.append(self.hidden_activation(self.bias_list[layer+1] + T.dot(u_tm1, self.recurrent_to_gsn_weights_list[layer/2])))
+            return h_list
         
         log.maybeLog(self.logger, "\nCreating recurrent step scan.")
         # For training, the deterministic recurrence is used to compute all the
         # {h_t, 1 <= t <= T} given Xs. Conditional GSNs can then be trained
         # in batches using those parameters.
-        u0 = T.zeros((self.recurrent_hidden_size,))  # initial value for the RNN hidden units
-        (ua, u, h_t), updates_recurrent = theano.scan(fn=lambda x_t, u_tm1, *_: recurrent_step(x_t, u_tm1, True),
-                                                           sequences=self.Xs,
-                                                           outputs_info=[None, u0, None],
-                                                           non_sequences=self.params)
-        
-        log.maybeLog(self.logger, "Now for reconstruction sample without noise")
-        (_, _, h_t_recon), updates_recurrent_recon = theano.scan(fn=lambda x_t, u_tm1, *_: recurrent_step(x_t, u_tm1, False),
-                                                           sequences=self.Xs,
-                                                           outputs_info=[None, u0, None],
-                                                           non_sequences=self.params)
-        # put together the hiddens list
-        h_list = [T.zeros_like(self.Xs)]
-        for layer, w in enumerate(self.weights_list):
-            if layer%2 != 0:
-                h_list.append(T.zeros_like(T.dot(h_list[-1], w)))
-            else:
-                h_list.append((h_t.T[(layer/2)*self.hidden_size:(layer/2+1)*self.hidden_size]).T)
-                
-        h_list_recon = [T.zeros_like(self.Xs)]
-        for layer, w in enumerate(self.weights_list):
-            if layer%2 != 0:
-                h_list_recon.append(T.zeros_like(T.dot(h_list_recon[-1], w)))
-            else:
-                h_list_recon.append((h_t_recon.T[(layer/2)*self.hidden_size:(layer/2+1)*self.hidden_size]).T)
+        if self.truncated_bptt:
+            # Truncated BPTT: each chunk starts from the final u of the previous chunk of the same sequence.
+            # The state is a shared variable rather than a parameter, so the gradient stops at the chunk boundary.
+            self.u_state = theano.shared(numpy.zeros((self.recurrent_hidden_size,), dtype='float32'), name='u_state')
+            u0 = self.u_state
+        else:
+            u0 = T.zeros((self.recurrent_hidden_size,))  # initial value for the RNN hidden units
+        (ua, u), updates_recurrent = theano.scan(fn=lambda xu_t, u_tm1, *_: recurrent_step(xu_t, u_tm1),
+                                                 sequences=x_u_projection,
+                                                 outputs_info=[None, u0],
+                                                 non_sequences=[self.W_u_u])
         
+        # The recurrence doesn't use any noise, so the noisy training walkbacks and the noiseless reconstruction
+        # walkbacks share this one scan instead of computing (and compiling) it twice.
+        # build_gsn_given_hiddens modifies the hiddens list inplace, so the reconstruction walkbacks get a copy
+        # of the list (holding the same hidden variables).
+        u_tm1 = T.concatenate([T.shape_padleft(u0), u[:-1]], axis=0)
+        h_list = recurrent_hiddens(u_tm1, self.Xs)
+        h_list_recon = list(h_list)
+        
+        # random number updates from the walkback scans (empty when unrolling)
+        updates_walkbacks = OrderedDict()
+        updates_recon = OrderedDict()
         #with noise
-        _, _, cost, show_cost, error = GSN.build_gsn_given_hiddens(self.Xs, h_list, self.weights_list, self.bias_list, True, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation, self.walkbacks, self.cost_function)
+        _, _, cost, show_cost, error = GSN.build_gsn_given_hiddens(self.Xs, h_list, self.walkback_weights_list, self.bias_list, True, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation, self.walkbacks, self.cost_function, self.unroll_walkbacks, updates_walkbacks)
         #without noise for reconstruction
-        x_sample_recon, _, _, recon_show_cost, _ = GSN.build_gsn_given_hiddens(self.Xs, h_list_recon, self.weights_list, self.bias_list, False, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation, self.walkbacks, self.cost_function)
+        x_sample_recon, _, _, recon_show_cost, _ = GSN.build_gsn_given_hiddens(self.Xs, h_list_recon, self.walkback_weights_list, self.bias_list, False, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation, self.walkbacks, self.cost_function, self.unroll_walkbacks, updates_recon)
+        
+        # copies, so the sgd updates added to updates_train don't end up in f_cost through the shared dict
+        updates_train = OrderedDict(updates_recurrent)
+        updates_train.update(updates_walkbacks)
+        updates_cost = OrderedDict(updates_recurrent)
+        updates_cost.update(updates_walkbacks)
+        if self.truncated_bptt:
+            # hand the last recurrent state on to the next chunk
+            updates_train[self.u_state] = u[-1]
+            updates_cost[self.u_state] = u[-1]
         
-        updates_train = updates_recurrent
-        updates_cost = updates_recurrent
+        # Multi-sequence mode: the same recurrence over a (time, sequences, input) batch of zero-padded sequences.
+        # Only the real (unmasked) timesteps of all sequences go through the GSN walkbacks as one matrix, so the
+        # padding costs nothing there and doesn't count in the cost.
+        if self.sequences_per_batch > 1:
+            log.maybeLog(self.logger, "\nCreating multi-sequence recurrent scan.")
+            self.Xb = T.ftensor3('Xb')
+            self.mask = T.fmatrix('mask')
+            xu_b = T.dot(self.Xb, self.W_x_u) + self.recurrent_bias
+            u0_b = T.zeros((self.Xb.shape[1], self.recurrent_hidden_size))
+            def masked_recurrent_step(xu_t, m_t, u_tm1):
+                ua_t, u_t = recurrent_step(xu_t, u_tm1)
+                # padded steps carry the previous state through
+                m_t = m_t.dimshuffle(0, 'x')
+                return [ua_t, m_t * u_t + (1 - m_t) * u_tm1]
+            (_, u_b), updates_recurrent_b = theano.scan(fn=lambda xu_t, m_t, u_tm1, *_: masked_recurrent_step(xu_t, m_t, u_tm1),
+                                                        sequences=[xu_b, self.mask],
+                                                        outputs_info=[None, u0_b],
+                                                        non_sequences=[self.W_u_u])
+            u_tm1_b = T.concatenate([T.shape_padleft(u0_b), u_b[:-1]], axis=0)
+            # flatten (time, sequences) and keep the real timesteps
+            steps = T.nonzero(self.mask.flatten())[0]
+            X_steps = self.Xb.reshape((self.Xb.shape[0]*self.Xb.shape[1], self.N_input))[steps]
+            u_tm1_steps = u_tm1_b.reshape((u_tm1_b.shape[0]*u_tm1_b.shape[1], self.recurrent_hidden_size))[steps]
+            h_list_b = recurrent_hiddens(u_tm1_steps, X_steps)
+            updates_walkbacks_b = OrderedDict()
+            _, _, cost_b, show_cost_b, error_b = GSN.build_gsn_given_hiddens(X_steps, h_list_b, self.walkback_weights_list, self.bias_list, True, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation, self.walkbacks, self.cost_function, self.unroll_walkbacks, updates_walkbacks_b)
+            updates_train_b = OrderedDict(updates_recurrent_b)
+            updates_train_b.update(updates_walkbacks_b)
+            updates_cost_b = OrderedDict(updates_recurrent_b)
+            updates_cost_b.update(updates_walkbacks_b)
         
         #############
         #   COSTS   #
         #############
+        # The functions are compiled lazily the first time they are used (see LazyFunctions), so processes
+        # that only sample or evaluate never compile the training graph. Use warm_functions to compile ahead.
         log.maybeLog(self.logger, '\nCost w.r.t p(X|...) at every step in the graph')
-        start_functions_time = time.time()
-
+        
         # if we are not using Hessian-free training create the normal sgd functions
         if not self.hessian_free:
-            gradient      = T.grad(cost, self.params)      
-            gradient_buffer = [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in self.params]
-            
-            m_gradient    = [self.momentum * gb + (cast32(1) - self.momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
-            param_updates = [(param, param - self.learning_rate * mg) for (param, mg) in zip(self.params, m_gradient)]
-            gradient_buffer_updates = zip(gradient_buffer, m_gradient)
+            def sgd_updates(cost):
+                gradient      = T.grad(cost, self.params)      
+                gradient_buffer = [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in self.params]
                 
-            updates = OrderedDict(param_updates + gradient_buffer_updates)
-            updates_train.update(updates)
-        
-            log.maybeLog(self.logger, "rnn-gsn learn...")
-            self.f_learn = theano.function(inputs  = [self.Xs],
-                                      updates = updates_train,
-                                      outputs = [show_cost, error],
-                                      on_unused_input='warn',
-                                      name='rnngsn_f_learn')
+                m_gradient    = [self.momentum * gb + (cast32(1) - self.momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
+                param_updates = [(param, param - self.learning_rate * mg) for (param, mg) in zip(self.params, m_gradient)]
+                gradient_buffer_updates = zip(gradient_buffer, m_gradient)
+                    
+                return OrderedDict(param_updates + gradient_buffer_updates)
+            
+            def build_f_learn():
+                updates_train.update(sgd_updates(cost))
+                log.maybeLog(self.logger, "rnn-gsn learn...")
+                return self.function('rnngsn_f_learn',
+                                     inputs  = [self.offset, self.index],
+                                     givens  = self.batch_givens,
+                                     updates = updates_train,
+                                     outputs = [show_cost, error],
+                                     on_unused_input='warn')
+            self.register_function('f_learn', build_f_learn)
             
             log.maybeLog(self.logger, "rnn-gsn cost...")
-            self.f_cost  = theano.function(inputs  = [self.Xs],
-                                      updates = updates_cost,
-                                      outputs = [show_cost, error],
-                                      on_unused_input='warn',
-                                      name='rnngsn_f_cost')
-        
-        log.maybeLog(self.logger, "Training/cost functions done.")
+            self.register_function('f_cost', lambda: self.function('rnngsn_f_cost',
+                                                                   inputs  = [self.offset, self.index],
+                                                                   givens  = self.batch_givens,
+                                                                   updates = updates_cost,
+                                                                   outputs = [show_cost, error],
+                                                                   on_unused_input='warn'))
+            
+            if self.sequences_per_batch > 1:
+                def build_f_learn_multi():
+                    updates_train_b.update(sgd_updates(cost_b))
+                    log.maybeLog(self.logger, "rnn-gsn multi-sequence learn...")
+                    return self.function('rnngsn_f_learn_multi',
+                                         inputs  = [self.Xb, self.mask],
+                                         updates = updates_train_b,
+                                         outputs = [show_cost_b, error_b],
+                                         on_unused_input='warn')
+                self.register_function('f_learn_multi', build_f_learn_multi)
+                self.register_function('f_cost_multi', lambda: self.function('rnngsn_f_cost_multi',
+                                                                             inputs  = [self.Xb, self.mask],
+                                                                             updates = updates_cost_b,
+                                                                             outputs = [show_cost_b, error_b],
+                                                                             on_unused_input='warn'))
         
         # Denoise some numbers : show number, noisy number, predicted number, reconstructed number
         log.maybeLog(self.logger, "Creating graph for noisy reconstruction function at checkpoints during training.")
-        self.f_recon = theano.function(inputs=[self.Xs],
-                                       outputs=[x_sample_recon[-1], recon_show_cost],
-                                       name='rnngsn_f_recon')
+        self.register_function('f_recon', lambda: self.function('rnngsn_f_recon',
+                                                                inputs=[self.Xs],
+                                                                outputs=[x_sample_recon[-1], recon_show_cost],
+                                                                updates=updates_recon))
         
         # a function to add salt and pepper noise
-        self.f_noise = theano.function(inputs = [self.X],
-                                       outputs = salt_and_pepper(self.X, self.input_salt_and_pepper),
-                                       name='rnngsn_f_noise')
+        self.register_function('f_noise', lambda: self.function('rnngsn_f_noise',
+                                                                inputs = [self.X],
+                                                                outputs = salt_and_pepper(self.X, self.input_salt_and_pepper, self.MRG)))
         # Sampling functions
         log.maybeLog(self.logger, "Creating sampling function...")
         if self.layers == 1: 
-            self.f_sample = theano.function(inputs = [X_sample],
-                                            outputs = visible_pX_chain[-1],
-                                            name='rnngsn_f_sample_single_layer')
+            self.register_function('f_sample', lambda: self.function('rnngsn_f_sample_single_layer',
+                                                                     inputs = [X_sample],
+                                                                     outputs = visible_pX_chain[-1]))
         else:
-            self.f_sample = theano.function(inputs = self.network_state_input,
-                                            outputs = self.network_state_output + visible_pX_chain,
-                                            on_unused_input='warn',
-                                            name='rnngsn_f_sample')
+            self.register_function('f_sample', lambda: self.function('rnngsn_f_sample',
+                                                                     inputs = self.network_state_input,
+                                                                     outputs = self.network_state_output + visible_pX_chain,
+                                                                     on_unused_input='warn'))
+        
+        # Streaming generation: advance the recurrence one frame at a time, keeping u_t between calls.
+        # p(x_t | u_(t-1)) is the noiseless walkback chain from the hiddens predicted by u_(t-1), like in training.
+        def predict_visible(u_tm1, updates):
+            hiddens = recurrent_hiddens(u_tm1, T.zeros((u_tm1.shape[0], self.N_input)))
+            p_X_chain = GSN.build_walkbacks(hiddens, self.walkback_weights_list, self.bias_list, False, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation, self.walkbacks, True, self.unroll_walkbacks, updates)
+            p_x = p_X_chain[-1]
+            x_sample = self.MRG.binomial(p=p_x, size=p_x.shape, dtype='float32') if self.input_sampling else p_x
+            return p_x, x_sample, hiddens
+        
+        self.x_stream = T.fmatrix('x_t')
+        self.u_stream = T.fmatrix('u_tm1')
+        log.maybeLog(self.logger, "Creating streaming step functions...")
+        self.register_function('f_stream_observe', lambda: self.function('rnngsn_f_stream_observe',
+                                                                         inputs  = [self.x_stream, self.u_stream],
+                                                                         outputs = recurrent_step(T.dot(self.x_stream, self.W_x_u) + self.recurrent_bias, self.u_stream)[1]))
+        def build_f_stream_predict():
+            updates_predict = OrderedDict()
+            p_x, x_sample, _ = predict_visible(self.u_stream, updates_predict)
+            return self.function('rnngsn_f_stream_predict',
+                                 inputs  = [self.u_stream],
+                                 outputs = [p_x, x_sample],
+                                 updates = updates_predict)
+        self.register_function('f_stream_predict', build_f_stream_predict)
+        self.reset_stream()
+        
+        # Free-running generation of whole sequences in one scan, like the recurrence(None, u_tm1) generator of
+        # the RNN-RBM: predict the hiddens from u_(t-1), run the walkbacks to sample x_t, then update u_t.
+        self.n_frames = T.iscalar('n_frames')
+        self.n_sequences = T.iscalar('n_sequences')
+        def generate_step(u_tm1):
+            # the walkback scan's updates have to be returned from the step, scan picks up the default_updates
+            # of the random streams drawn in the step itself
+            step_updates = OrderedDict()
+            _, x_t, _ = predict_visible(u_tm1, step_updates)
+            u_t = recurrent_step(T.dot(x_t, self.W_x_u) + self.recurrent_bias, u_tm1)[1]
+            return [x_t, u_t], step_updates
+        def build_f_generate():
+            log.maybeLog(self.logger, "Creating generation scan...")
+            u0_generate = T.zeros((self.n_sequences, self.recurrent_hidden_size))
+            (x_generated, _), updates_generate = theano.scan(fn=lambda u_tm1, *_: generate_step(u_tm1),
+                                                             outputs_info=[None, u0_generate],
+                                                             non_sequences=self.params + [w for w in getattr(self.walkback_weights_list, 'stacked', []) if w is not None],
+                                                             n_steps=self.n_frames)
+            return self.function('rnngsn_f_generate',
+                                 inputs  = [self.n_frames, self.n_sequences],
+                                 outputs = x_generated,
+                                 updates = updates_generate)
+        self.register_function('f_generate', build_f_generate)
+        
+        log.maybeLog(self.logger, "Done building all graphs - functions will be compiled on first use.\n\n")
         
+        
+    def function(self, name, **kwargs):
+        """
+        Compiles a theano function, going through the compiled function cache if it is enabled.
+        """
+        if self.function_cache is not None:
+            return self.function_cache.function(name, **kwargs)
+        return theano.function(name=name, **kwargs)
+    
+    def apply_to_buffer(self, function, start, length):
+        """
+        Applies the (offset, index)-taking function to each minibatch of the sequence at start in the data buffer.
+        """
+        if self.truncated_bptt:
+            self.reset_recurrent_state()
+        return data.apply_indexed_cost_function_to_dataset(lambda i: function(start, i), length, self.batch_size)
     
-        log.maybeLog(self.logger, "Done compiling all functions.")
-        compilation_time = time.time() - start_functions_time
-        # Show the compile time with appropriate easy-to-read units.
-        log.maybeLog(self.logger, "Total compilation time took "+make_time_units_string(compilation_time)+".\n\n")
-      
+    def reset_recurrent_state(self):
+        # a new sequence starts from the zero state
+        self.u_state.set_value(numpy.zeros((self.recurrent_hidden_size,), dtype='float32'))
+    
+    def load_resident_splits(self, splits):
+        """
+        Uploads the sequences of all the splits (i.e. train, valid and test) into the data buffer once, one after
+        the other, so training only passes offsets and minibatch indices and the data stays on the device.
         
+        @type  splits: List
+        @param splits: Lists of datasets (SequenceDatasets or per-song shared datasets), or None for a missing split.
+                       Packed datasets go through apply_to_packed_datasets instead.
+        
+        @rtype:   List
+        @return:  the (start, length) spans of each split's sequences in the data buffer (None for missing splits)
+        """
+        arrays = []
+        split_spans = []
+        position = 0
+        for datasets in splits:
+            if datasets is None:
+                split_spans.append(None)
+                continue
+            spans = []
+            for dataset in datasets:
+                if isinstance(dataset, data.SequenceDataset):
+                    if len(dataset.data) > 0:
+                        # an empty split's buffer may not have the feature width to concatenate with
+                        arrays.append(dataset.data)
+                    spans.extend([(position + start, length) for start, length in dataset.spans()])
+                    position += len(dataset.data)
+                else:
+                    values = dataset.get_value(borrow=True)
+                    arrays.append(values)
+                    spans.append((position, len(values)))
+                    position += len(values)
+            split_spans.append(spans)
+        if arrays:
+            self.data_buffer.set_value(numpy.concatenate(arrays).astype('float32'), borrow=True)
+        return split_spans
+    
+    def apply_to_spans(self, function, spans):
+        """
+        Applies the (offset, index)-taking function to every minibatch of the sequences at the given spans of the
+        resident data buffer (see load_resident_splits).
+        
+        @rtype:   Tuple
+        @return:  the outputs of each call, and None for the data wait - the data is already resident
+        """
+        outputs = []
+        for start, length in spans:
+            outputs.extend(self.apply_to_buffer(function, start, length))
+        return outputs, None
+    
+    def apply_to_packed_datasets(self, function, datasets):
+        """
+        Applies the (offset, index)-taking function to every minibatch of the datasets, uploading one song at a
+        time into the data buffer. Used for bit-packed datasets, which would lose their memory savings if they
+        were unpacked into one resident buffer. The songs are unpacked in a background thread.
+        
+        @rtype:   Tuple
+        @return:  the outputs of each call, the time spent waiting for the unpacked songs
+        """
+        songs = Prefetcher((numpy.ascontiguousarray(dataset.get_value(borrow=True), dtype='float32') for dataset in datasets), self.prefetch)
+        outputs = []
+        for song in songs:
+            self.data_buffer.set_value(song, borrow=True)
+            outputs.extend(self.apply_to_buffer(function, 0, len(song)))
+        return outputs, songs.wait_time
+    
+    def apply_to_sequence_batches(self, function, datasets):
+        """
+        Applies the (Xb, mask)-taking function to padded batches of sequences_per_batch similar-length sequences
+        of the SequenceDatasets, cut into batch_size timestep chunks. The batches are built in a background thread.
+        """
+        batches = Prefetcher((batch for dataset in datasets
+                              for batch in dataset.padded_batches(self.sequences_per_batch, self.batch_size)), self.prefetch)
+        outputs = [function(xs, mask) for xs, mask in batches]
+        return outputs, batches.wait_time
+    
+    def as_sequence_datasets(self, datasets):
+        # the multi-sequence mode batches across songs, so it needs them in one SequenceDataset
+        if datasets is None or all([isinstance(dataset, data.SequenceDataset) for dataset in datasets]):
+            return datasets
+        return [data.SequenceDataset([dataset.get_value(borrow=True) for dataset in datasets])]
         
     def train(self, train_X=None, train_Y=None, valid_X=None, valid_Y=None, test_X=None, test_Y=None, is_artificial=False, artificial_sequence=1, continue_training=False):
         log.maybeLog(self.logger, "\nTraining---------\n")
@@ -461,6 +724,21 @@ class RNN_GSN():
         ################################
         else:
             log.maybeLog(self.logger, "\n-----------TRAINING RNN-GSN------------\n")
+            if self.sequences_per_batch > 1:
+                # padded, masked batches of several similar-length sequences per step
+                train_X = self.as_sequence_datasets(train_X)
+                valid_X = self.as_sequence_datasets(valid_X)
+                test_X  = self.as_sequence_datasets(test_X)
+                f_learn, f_cost, apply_to = self.f_learn_multi, self.f_cost_multi, self.apply_to_sequence_batches
+                train_data, valid_data, test_data = train_X, valid_X, test_X
+            elif any([isinstance(dataset, data.PackedBinaryDataset) for datasets in [train_X, valid_X, test_X] if datasets is not None for dataset in datasets]):
+                # packed splits stay packed, each song is unpacked into the data buffer right before training on it
+                train_data, valid_data, test_data = train_X, valid_X, test_X
+                f_learn, f_cost, apply_to = self.f_learn, self.f_cost, self.apply_to_packed_datasets
+            else:
+                # all splits go into the data buffer once - each epoch only passes offsets and indices
+                train_data, valid_data, test_data = self.load_resident_splits([train_X, valid_X, test_X])
+                f_learn, f_cost, apply_to = self.f_learn, self.f_cost, self.apply_to_spans
             # TRAINING
             STOP        =   False
             counter     =   0
@@ -471,11 +749,11 @@ class RNN_GSN():
             best_params = None
             patience = 0
                         
-            log.maybeLog(self.logger, ['train X size:',str(train_X[0].get_value(borrow=True).shape)])
+            log.maybeLog(self.logger, ['train X size:',str(data.dataset_shape(train_X[0]))])
             if valid_X is not None:
-                log.maybeLog(self.logger, ['valid X size:',str(valid_X[0].get_value(borrow=True).shape)])
+                log.maybeLog(self.logger, ['valid X size:',str(data.dataset_shape(valid_X[0]))])
             if test_X is not None:
-                log.maybeLog(self.logger, ['test X size:',str(test_X[0].get_value(borrow=True).shape)])
+                log.maybeLog(self.logger, ['test X size:',str(data.dataset_shape(test_X[0]))])
             
             if self.vis_init:
                 self.bias_list[0].set_value(logit(numpy.clip(0.9,0.001,train_X[0].get_value(borrow=True).mean(axis=0))))
@@ -491,32 +769,26 @@ class RNN_GSN():
 #                     data.sequence_mnist_data(train_X[0], train_Y[0], valid_X[0], valid_Y[0], test_X[0], test_Y[0], artificial_sequence, rng)
                      
                 #train
-                train_costs = []
-                train_errors = []
-                for train_data in train_X:
-                    costs_and_errors = data.apply_cost_function_to_dataset(self.f_learn, train_data, self.batch_size)
-                    train_costs.extend([cost for (cost, error) in costs_and_errors])
-                    train_errors.extend([error for (cost, error) in costs_and_errors])
+                costs_and_errors, wait_time = apply_to(f_learn, train_data)
+                train_costs = [cost for (cost, error) in costs_and_errors]
+                train_errors = [error for (cost, error) in costs_and_errors]
                 log.maybeAppend(self.logger, ['Train:',trunc(numpy.mean(train_costs)),trunc(numpy.mean(train_errors)),'\t'])
+                if wait_time is not None:
+                    log.maybeAppend(self.logger, ['data wait:',make_time_units_string(wait_time),'\t'])
          
          
                 #valid
                 if valid_X is not None:
-                    valid_costs = []
-                    for valid_data in valid_X:
-                        cs = data.apply_cost_function_to_dataset(self.f_cost, valid_data, self.batch_size)
-                        valid_costs.extend([c for c,e in cs])
+                    cs, _ = apply_to(f_cost, valid_data)
+                    valid_costs = [c for c,e in cs]
                     log.maybeAppend(self.logger, ['Valid:',trunc(numpy.mean(valid_costs)), '\t'])
          
          
                 #test
                 if test_X is not None:
-                    test_costs = []
-                    test_errors = []
-                    for test_data in test_X:
-                        costs_and_errors = data.apply_cost_function_to_dataset(self.f_cost, test_data, self.batch_size)
-                        test_costs.extend([cost for (cost, error) in costs_and_errors])
-                        test_errors.extend([error for (cost, error) in costs_and_errors])
+                    costs_and_errors, _ = apply_to(f_cost, test_data)
+                    test_costs = [cost for (cost, error) in costs_and_errors]
+                    test_errors = [error for (cost, error) in costs_and_errors]
                     log.maybeAppend(self.logger, ['Test:',trunc(numpy.mean(test_costs)),trunc(numpy.mean(test_errors)), '\t'])
                 
                  
@@ -548,9 +820,16 @@ class RNN_GSN():
         
                 if (counter % self.save_frequency) == 0 or STOP is True:
                     n_examples = 100
-                    xs_test = test_X[0].get_value(borrow=True)[range(n_examples)]
-                    noisy_xs_test = self.f_noise(test_X[0].get_value(borrow=True)[range(n_examples)])
+                    if isinstance(test_X[0], data.SequenceDataset):
+                        # stay inside the first song so the recon doesn't run across a song boundary
+                        xs_test = test_X[0][0][:n_examples]
+                    else:
+                        xs_test = data.dataset_rows(test_X[0], 0, n_examples)
+                    noisy_xs_test = self.f_noise(xs_test)
                     reconstructions = []
+                    if self.truncated_bptt:
+                        # each reconstruction window starts its recurrence from the zero state
+                        self.reset_recurrent_state()
                     for i in xrange(0, len(noisy_xs_test)):
                         recon, recon_cost = self.f_recon(noisy_xs_test[max(0,(i+1)-self.batch_size):i+1])
                         reconstructions.append(recon[-1])
@@ -586,10 +865,31 @@ class RNN_GSN():
     
     
     
+    def get_numpy_gsn(self):
+        """
+        Returns a NumpyGSN over the current GSN weights and biases, which samples without any theano functions.
+        Only works for models built with named activations (hidden_act/visible_act or the defaults), since
+        arbitrary theano activation callables have no numpy counterpart.
+        """
+        for act, name in [(self.hidden_act, 'hidden'), (self.visible_act, 'visible')]:
+            if act is None:
+                raise ValueError("The NumpyGSN can't run the specified {0!s} activation function, build the model with {0!s}_act instead".format(name))
+        return NumpyGSN(self.weights_list,
+                        self.bias_list,
+                        visible_activation=self.visible_act,
+                        hidden_activation=self.hidden_act,
+                        noiseless_h1=self.noiseless_h1,
+                        hidden_add_noise_sigma=self.hidden_add_noise_sigma,
+                        input_salt_and_pepper=self.input_salt_and_pepper,
+                        input_sampling=self.input_sampling,
+                        fused=self.fused_layer_update,
+                        logger=self.logger)
+    
     def gen_10k_samples(self):
+        numpy_gsn = self.get_numpy_gsn()
         for i,x in enumerate(self.test_X):
             log.maybeLog(self.logger, 'Generating 10,000 samples {0!s}/{1!s}'.format(i,len(self.test_X)))
-            samples, _ = self.sample(x.get_value()[1:2], 1000, 1)
+            samples, _ = numpy_gsn.sample(data.dataset_rows(x, 1, 2), 1000, 1)
             f_samples = 'samples_test{0!s}.npy'.format(i)
             numpy.save(f_samples, samples)
             log.maybeLog(self.logger, 'saved digits')
@@ -657,6 +957,85 @@ class RNN_GSN():
         else:
             return sample_some_numbers(n_samples)
         
+    def reset_stream(self, n_streams=1):
+        """
+        Starts n_streams new streams for step/generate from the zero recurrent state.
+        The stream state is only the recurrent state u_t; the GSN hiddens are re-predicted from u_t on every step.
+        """
+        self.stream_u = numpy.zeros((n_streams, self.recurrent_hidden_size), dtype='float32')
+        # the prediction for the next frame: p(x) and a sample of x
+        self.stream_prediction = None
+    
+    def predict_stream(self):
+        p_x, x_sample = self.f_stream_predict(self.stream_u)
+        self.stream_prediction = (p_x, x_sample)
+        return p_x
+    
+    def step(self, x_t):
+        """
+        Observes the frame x_t (one row per stream) and advances the stream state by one recurrence update,
+        then runs the walkbacks for the next frame from hiddens predicted off the new u_t.
+        x_t needs one row per stream; call reset_stream(n) first to change the number of streams.
+        
+        @rtype:   numpy array
+        @return:  p(x_(t+1) | x_1..x_t) for each stream
+        """
+        x_t = numpy.asarray(x_t, dtype='float32')
+        if x_t.ndim == 1:
+            x_t = x_t.reshape((1, -1))
+        if len(x_t) != len(self.stream_u):
+            raise ValueError("step got {0!s} frames for {1!s} streams, call reset_stream({0!s}) to start {0!s} new streams".format(len(x_t), len(self.stream_u)))
+        self.stream_u = self.f_stream_observe(x_t, self.stream_u)
+        return self.predict_stream()
+    
+    def generate(self, n):
+        """
+        Continues the streams for n frames, feeding each sampled frame back in with step.
+        
+        @rtype:   numpy array
+        @return:  the generated frames of shape (n, n_streams, input_size)
+        """
+        if self.stream_prediction is None:
+            self.predict_stream()
+        frames = []
+        for _ in xrange(n):
+            x_t = self.stream_prediction[1]
+            frames.append(x_t)
+            self.step(x_t)
+        return numpy.array(frames)
+        
+    def generate_sequences(self, n_frames, n_sequences=1):
+        """
+        Generates n_sequences sequences of n_frames frames from the zero recurrent state in one compiled scan.
+        
+        @rtype:   numpy array
+        @return:  the generated frames of shape (n_frames, n_sequences, input_size)
+        """
+        return self.f_generate(n_frames, n_sequences)
+        
+    def sample_chains(self, initial, n_chains=100, n_steps=100, burn_in=0, thin=1):
+        """
+        Runs n_chains independent sampling chains together as the rows of one minibatch through f_sample.
+        
+        @rtype:   numpy array
+        @return:  visible samples of shape (n_chains, n_steps, input_size)
+        """
+        log.maybeLog(self.logger, "Starting batched sampling of {0!s} chains...".format(n_chains))
+        t = time.time()
+        if self.layers == 1:
+            # the single layer f_sample only returns p(X|H), so sample and corrupt the next input here
+            def f_sample(x):
+                p = self.f_sample(x)
+                x = rng.binomial(n=1, p=p, size=p.shape).astype('float32')
+                return [self.f_noise(x), p]
+            hidden_sizes = []
+        else:
+            f_sample = self.f_sample
+            hidden_sizes = self.layer_sizes[1:]
+        samples = sample_chains(f_sample, self.f_noise, initial, hidden_sizes, n_chains, n_steps, burn_in, thin)
+        log.maybeLog(self.logger, "Sampling done, took "+make_time_units_string(time.time() - t))
+        return samples
+        
     def plot_samples(self, epoch_number="", leading_text="", n_samples=400):
         to_sample = time.time()
         initial = self.test_X.get_value(borrow=True)[:1]
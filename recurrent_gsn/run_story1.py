@@ -19,6 +19,7 @@ def main():
     parser.add_argument('--cost_funct', type=str, default='binary_crossentropy') # the cost function for training
     parser.add_argument('--n_epoch', type=int, default=30)
     parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--prefetch', type=int, default=2) # number of minibatches prepared in a background thread
     parser.add_argument('--save_frequency', type=int, default=10) #number of epochs between parameters being saved
     parser.add_argument('--early_stop_threshold', type=float, default=0.9995) #0.9995
     parser.add_argument('--early_stop_length', type=int, default=30)
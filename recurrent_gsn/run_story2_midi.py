@@ -28,10 +28,15 @@ def main():
     parser.add_argument('--n_epoch', type=int, default=500)
     parser.add_argument('--gsn_batch_size', type=int, default=100)
     parser.add_argument('--batch_size', type=int, default=200) # max length of sequence to consider
+    parser.add_argument('--sequences_per_batch', type=int, default=1) # train on padded batches of this many similar-length songs
+    parser.add_argument('--truncated_bptt', type=int, default=0) # carry the recurrent state between the batch_size chunks of a song
     parser.add_argument('--save_frequency', type=int, default=10) #number of epochs between parameters being saved
     parser.add_argument('--early_stop_threshold', type=float, default=0.9995) #0.9995
     parser.add_argument('--early_stop_length', type=int, default=30)
     parser.add_argument('--hessian_free', type=int, default=0) # boolean for whether or not to use Hessian-free training for RNN-GSN
+    parser.add_argument('--unroll_walkbacks', type=int, default=0) # unroll the GSN walkbacks in the graph instead of using a scan
+    parser.add_argument('--cache_functions', type=int, default=0) # keep the compiled theano functions in a cache in the output directory
+    parser.add_argument('--fused_layer_update', type=int, default=0) # update the in-between GSN layers with one GEMM over both neighbours
     
     # noise
     parser.add_argument('--hidden_add_noise_sigma', type=float, default=2)
@@ -47,6 +52,7 @@ def main():
     # data
     parser.add_argument('--dataset', type=str, default='nottingham')
     parser.add_argument('--data_path', type=str, default='../data/')
+    parser.add_argument('--packed', type=int, default=0) # keep the piano rolls bit-packed in memory, unpacking each song before training on it
     parser.add_argument('--outdir_base', type=str, default='../outputs/rnn_gsn/')
    
     # argparse does not deal with booleans
@@ -59,11 +65,16 @@ def main():
     return parser.parse_args()
     
 def create_rnngsn(args):
-    (train,_), (valid,_), (test,_) = data.load_datasets(args.dataset, args.data_path)
-              
-    train_X = [theano.shared(t, borrow=True) for t in train]
-    valid_X = [theano.shared(v, borrow=True) for v in valid]
-    test_X  = [theano.shared(t, borrow=True) for t in test]
+    (train,_), (valid,_), (test,_) = data.load_datasets(args.dataset, args.data_path, args.packed)
+    
+    if args.packed:
+        # RNN_GSN keeps packed splits packed and unpacks one song at a time into its data buffer while training
+        train_X, valid_X, test_X = train, valid, test
+    else:
+        # all songs of a split in one contiguous buffer instead of a shared variable per song
+        train_X = data.SequenceDataset(train)
+        valid_X = data.SequenceDataset(valid, n_features=train_X.shape[1])
+        test_X  = data.SequenceDataset(test, n_features=train_X.shape[1])
     
     args.is_image = True
     
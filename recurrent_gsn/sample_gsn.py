@@ -3,7 +3,7 @@ import os
 
 import numpy
 
-from recurrent_gsn.generative_stochastic_network import GSN
+from recurrent_gsn.numpy_gsn import NumpyGSN
 from utils import data_tools as data
 import utils.logger as log
 from utils.utils import load_from_config
@@ -102,19 +102,23 @@ def main():
     else:
         raise AssertionError("Dataset not recognized. Please try MNIST, or implement your own data processing method in data_tools.py")
 
-    # transfer the datasets into theano shared variables
-    train_X, train_Y = data.shared_dataset((train_X, train_Y), borrow=True)
-    valid_X, valid_Y = data.shared_dataset((valid_X, valid_Y), borrow=True)
-    test_X, test_Y   = data.shared_dataset((test_X, test_Y), borrow=True)
-     
-    ##########################        
-    # Initialize the new GSN #
-    ##########################
-    gsn = GSN(train_X, valid_X, test_X, vars(args), logger)
-#     gsn.train()
+    ############################
+    # Initialize the numpy GSN #
+    ############################
+    # sampling only needs the trained weights - use the numpy engine so no theano graph has to be compiled
+    gsn = NumpyGSN.load('gsn_params_mnist.pkl', args.layers,
+                        visible_activation=args.visible_act,
+                        hidden_activation=args.hidden_act,
+                        noiseless_h1=args.noiseless_h1,
+                        hidden_add_noise_sigma=args.hidden_add_noise_sigma,
+                        input_salt_and_pepper=args.input_salt_and_pepper,
+                        input_sampling=args.input_sampling,
+                        logger=logger)
     
-    gsn.load_params('gsn_params_mnist.pkl')
-    gsn.gen_10k_samples()
+    logger.log('Generating 10,000 samples')
+    samples, _ = gsn.sample(test_X[:1], 10000, 1)
+    numpy.save('samples.npy', samples)
+    logger.log('saved digits')
     # parzen
     print 'Evaluating parzen window'
     import utils.likelihood_estimation as ll
@@ -20,6 +20,7 @@ import theano.sandbox.rng_mrg as RNG_MRG
 from utils import data_tools as data
 from recurrent_gsn import generative_stochastic_network
 import utils.logger as log
+from utils.lazy_functions import LazyFunctions
 from utils.image_tiler import tile_raster_images
 from utils.utils import cast32, logit, trunc, get_shared_weights, get_shared_bias, salt_and_pepper, \
     make_time_units_string
@@ -71,7 +72,7 @@ defaults = {# gsn parameters
             "output_path": '../outputs/sen/'}
 
 
-class SEN():
+class SEN(LazyFunctions):
     '''
     Class for creating a new Sequence Encoder Network (SEN)
     '''
@@ -132,8 +133,6 @@ class SEN():
         self.recurrent_hidden_size = args.get('recurrent_hidden_size', defaults['recurrent_hidden_size'])
         self.top_layer_sizes = [self.recurrent_hidden_size] + [args.get('hidden_size', defaults['hidden_size'])] * self.gsn_layers # layer sizes, from h0 to hK (h0 is the visible layer)
         
-        self.f_recon = None
-        self.f_noise = None
         
         # Activation functions!
         # For the GSN:
@@ -214,6 +213,12 @@ class SEN():
         ############################
         self.X = T.fmatrix('X') #single (batch) for training gsn
         self.Xs = T.fmatrix('Xs') #sequence for training rnn
+        # the training functions take the offset of a dataset in data_buffer and a minibatch index into it,
+        # and slice the minibatch from the buffer through givens
+        self.offset = T.lscalar('offset')
+        self.index = T.lscalar('index')
+        self.data_buffer = theano.shared(numpy.zeros((self.batch_size, self.N_input), dtype='float32'), name='data_buffer')
+        self.batch_givens = {self.Xs: self.data_buffer[self.offset + self.index*self.batch_size : self.offset + (self.index+1)*self.batch_size]}
         self.MRG = RNG_MRG.MRG_RandomStreams(1)
         
         ###############
@@ -331,144 +336,162 @@ class SEN():
     
         # ONE update
         log.maybeLog(self.logger, "Performing one walkback in network state sampling.")
-        generative_stochastic_network.update_layers(self.network_state_output,
-                          self.weights_list,
-                          self.bias_list,
-                          visible_pX_chain, 
-                          True,
-                          self.noiseless_h1,
-                          self.hidden_add_noise_sigma,
-                          self.input_salt_and_pepper,
-                          self.input_sampling,
-                          self.MRG,
-                          self.visible_activation,
-                          self.hidden_activation,
-                          self.logger)
+        generative_stochastic_network.GSN.update_layers(self.network_state_output,
+                                                        self.weights_list,
+                                                        self.bias_list,
+                                                        visible_pX_chain,
+                                                        True,
+                                                        self.noiseless_h1,
+                                                        self.hidden_add_noise_sigma,
+                                                        self.input_salt_and_pepper,
+                                                        self.input_sampling,
+                                                        self.MRG,
+                                                        self.visible_activation,
+                                                        self.hidden_activation,
+                                                        self.logger)
     
                
         ##############################################
         #        Build the graphs for the SEN        #
         ##############################################
-        # If `x_t` is given, deterministic recurrence to compute the u_t. Otherwise, first generate
-        def recurrent_step(x_t, u_tm1, add_noise):
-            # Make current guess for hiddens based on U
-            for i in range(self.gsn_layers):
-                if i%2 == 0:
-                    log.maybeLog(self.logger, "Using {0!s} and {1!s}".format(self.recurrent_to_gsn_weights_list[(i+1)/2],self.bias_list[i+1]))
-            h_t = T.concatenate([self.hidden_activation(self.bias_list[i+1] + T.dot(u_tm1, self.recurrent_to_gsn_weights_list[(i+1)/2])) for i in range(self.gsn_layers) if i%2 == 0],axis=0)
-            
-            # Make a GSN to update U
-            _, hs = generative_stochastic_network.build_gsn(x_t, self.weights_list, self.bias_list, add_noise, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation, self.walkbacks, self.logger)
-            htop_t = hs[-1]
-            ins_t = htop_t
-            
-            ua_t = T.dot(ins_t, self.W_ins_u) + T.dot(u_tm1, self.W_u_u) + self.recurrent_bias
+        # The GSN encoder doesn't depend on u_tm1, so run it over the whole Xs sequence as one batch instead of
+        # unrolling a full multi-walkback GSN once per timestep inside the scan. Its top layer activations are
+        # projected with W_ins_u in one GEMM, leaving only the u_tm1 . W_u_u term inside the recurrence.
+        def encoder_projection(add_noise):
+            _, hs = generative_stochastic_network.GSN.build_gsn(self.Xs, self.weights_list, self.bias_list, add_noise, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation, self.walkbacks)
+            htop = hs[-1]
+            return T.dot(htop, self.W_ins_u) + self.recurrent_bias
+        
+        def recurrent_step(ins_t, u_tm1):
+            ua_t = ins_t + T.dot(u_tm1, self.W_u_u)
             u_t = self.recurrent_hidden_activation(ua_t)
-            return [ua_t, u_t, h_t]
+            return [ua_t, u_t]
+        
+        # Make the guess for the GSN hiddens at time t based on u_(t-1), applied to the stacked u's after the scan.
+        def recurrent_hiddens(u):
+            u_tm1 = T.concatenate([T.shape_padleft(u0), u[:-1]], axis=0)
+            h_list = [T.zeros_like(self.Xs)]
+            for layer, w in enumerate(self.weights_list):
+                if layer%2 != 0:
+                    h_list.append(T.zeros_like(T.dot(h_list[-1], w)))
+                else:
+                    log.maybeLog(self.logger, "Using {0!s} and {1!s}".format(self.recurrent_to_gsn_weights_list[layer/2],self.bias_list[layer+1]))
+                    h_list.append(self.hidden_activation(self.bias_list[layer+1] + T.dot(u_tm1, self.recurrent_to_gsn_weights_list[layer/2])))
+            return h_list
         
         log.maybeLog(self.logger, "\nCreating recurrent step scan.")
         # For training, the deterministic recurrence is used to compute all the
         # {h_t, 1 <= t <= T} given Xs. Conditional GSNs can then be trained
         # in batches using those parameters.
         u0 = T.zeros((self.recurrent_hidden_size,))  # initial value for the RNN hidden units
-        (ua, u, h_t), updates_recurrent = theano.scan(fn=lambda x_t, u_tm1, *_: recurrent_step(x_t, u_tm1, True),
-                                                           sequences=self.Xs,
-                                                           outputs_info=[None, u0, None],
-                                                           non_sequences=self.params)
+        (ua, u), updates_recurrent = theano.scan(fn=lambda ins_t, u_tm1, *_: recurrent_step(ins_t, u_tm1),
+                                                 sequences=encoder_projection(True),
+                                                 outputs_info=[None, u0],
+                                                 non_sequences=[self.W_u_u])
         
         log.maybeLog(self.logger, "Now for reconstruction sample without noise")
-        (_, _, h_t_recon), updates_recurrent_recon = theano.scan(fn=lambda x_t, u_tm1, *_: recurrent_step(x_t, u_tm1, False),
-                                                           sequences=self.Xs,
-                                                           outputs_info=[None, u0, None],
-                                                           non_sequences=self.params)
+        (_, u_recon), updates_recurrent_recon = theano.scan(fn=lambda ins_t, u_tm1, *_: recurrent_step(ins_t, u_tm1),
+                                                            sequences=encoder_projection(False),
+                                                            outputs_info=[None, u0],
+                                                            non_sequences=[self.W_u_u])
         # put together the hiddens list
-        h_list = [T.zeros_like(self.Xs)]
-        for layer, w in enumerate(self.weights_list):
-            if layer%2 != 0:
-                h_list.append(T.zeros_like(T.dot(h_list[-1], w)))
-            else:
-                h_list.append((h_t.T[(layer/2)*self.hidden_size:(layer/2+1)*self.hidden_size]).T)
-                
-        h_list_recon = [T.zeros_like(self.Xs)]
-        for layer, w in enumerate(self.weights_list):
-            if layer%2 != 0:
-                h_list_recon.append(T.zeros_like(T.dot(h_list_recon[-1], w)))
-            else:
-                h_list_recon.append((h_t_recon.T[(layer/2)*self.hidden_size:(layer/2+1)*self.hidden_size]).T)
+        h_list = recurrent_hiddens(u)
+        h_list_recon = recurrent_hiddens(u_recon)
         
-        #with noise
-        _, cost, show_cost = generative_stochastic_network.build_gsn_given_hiddens(self.Xs, h_list, self.weights_list, self.bias_list, True, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation, self.walkbacks, self.cost_function, self.logger)
+        #with noise (unrolled walkbacks, so there are no scan random number updates to collect)
+        _, _, cost, show_cost, _ = generative_stochastic_network.GSN.build_gsn_given_hiddens(self.Xs, h_list, self.weights_list, self.bias_list, True, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation, self.walkbacks, self.cost_function, True)
         #without noise for reconstruction
-        x_sample_recon, _, _ = generative_stochastic_network.build_gsn_given_hiddens(self.Xs, h_list_recon, self.weights_list, self.bias_list, False, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation, self.walkbacks, self.cost_function, self.logger)
+        x_sample_recon, _, _, _, _ = generative_stochastic_network.GSN.build_gsn_given_hiddens(self.Xs, h_list_recon, self.weights_list, self.bias_list, False, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation, self.walkbacks, self.cost_function, True)
         
-        updates_train = updates_recurrent
-        updates_cost = updates_recurrent
+        # copies, so the sgd updates added to updates_train don't end up in f_cost through the shared dict
+        updates_train = OrderedDict(updates_recurrent)
+        updates_cost = OrderedDict(updates_recurrent)
         
         #############
         #   COSTS   #
         #############
+        # The functions are compiled lazily the first time they are used (see LazyFunctions), so processes
+        # that only sample or evaluate never compile the training graph. Use warm_functions to compile ahead.
         log.maybeLog(self.logger, '\nCost w.r.t p(X|...) at every step in the graph')
-        start_functions_time = time.time()
 
         # if we are not using Hessian-free training create the normal sgd functions
         if not self.hessian_free:
-            gradient      = T.grad(cost, self.params)      
-            gradient_buffer = [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in self.params]
-            
-            m_gradient    = [self.momentum * gb + (cast32(1) - self.momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
-            param_updates = [(param, param - self.learning_rate * mg) for (param, mg) in zip(self.params, m_gradient)]
-            gradient_buffer_updates = zip(gradient_buffer, m_gradient)
+            def build_f_learn():
+                # the top level GSN parameters aren't part of this cost
+                gradient      = T.grad(cost, self.params, disconnected_inputs='warn')
+                gradient_buffer = [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in self.params]
                 
-            updates = OrderedDict(param_updates + gradient_buffer_updates)
-            updates_train.update(updates)
-        
-            log.maybeLog(self.logger, "rnn-gsn learn...")
-            self.f_learn = theano.function(inputs  = [self.Xs],
-                                      updates = updates_train,
-                                      outputs = show_cost,
-                                      on_unused_input='warn',
-                                      name='rnngsn_f_learn')
+                m_gradient    = [self.momentum * gb + (cast32(1) - self.momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
+                param_updates = [(param, param - self.learning_rate * mg) for (param, mg) in zip(self.params, m_gradient)]
+                gradient_buffer_updates = zip(gradient_buffer, m_gradient)
+                    
+                updates = OrderedDict(param_updates + gradient_buffer_updates)
+                updates_train.update(updates)
+            
+                log.maybeLog(self.logger, "rnn-gsn learn...")
+                return theano.function(inputs  = [self.offset, self.index],
+                                       givens  = self.batch_givens,
+                                       updates = updates_train,
+                                       outputs = show_cost,
+                                       on_unused_input='warn',
+                                       name='rnngsn_f_learn')
+            self.register_function('f_learn', build_f_learn)
             
             log.maybeLog(self.logger, "rnn-gsn cost...")
-            self.f_cost  = theano.function(inputs  = [self.Xs],
-                                      updates = updates_cost,
-                                      outputs = show_cost, 
-                                      on_unused_input='warn',
-                                      name='rnngsn_f_cost')
-        
-        log.maybeLog(self.logger, "Training/cost functions done.")
+            self.register_function('f_cost', lambda: theano.function(inputs  = [self.offset, self.index],
+                                                                     givens  = self.batch_givens,
+                                                                     updates = updates_cost,
+                                                                     outputs = show_cost, 
+                                                                     on_unused_input='warn',
+                                                                     name='rnngsn_f_cost'))
         
         # Denoise some numbers : show number, noisy number, predicted number, reconstructed number
         log.maybeLog(self.logger, "Creating graph for noisy reconstruction function at checkpoints during training.")
-        self.f_recon = theano.function(inputs=[self.Xs],
-                                       outputs=x_sample_recon[-1],
-                                       updates=updates_recurrent_recon,
-                                       name='rnngsn_f_recon')
+        self.register_function('f_recon', lambda: theano.function(inputs=[self.Xs],
+                                                                  outputs=x_sample_recon[-1],
+                                                                  updates=updates_recurrent_recon,
+                                                                  name='rnngsn_f_recon'))
         
         # a function to add salt and pepper noise
-        self.f_noise = theano.function(inputs = [self.X],
-                                       outputs = salt_and_pepper(self.X, self.input_salt_and_pepper),
-                                       name='rnngsn_f_noise')
+        self.register_function('f_noise', lambda: theano.function(inputs = [self.X],
+                                                                  outputs = salt_and_pepper(self.X, self.input_salt_and_pepper, self.MRG),
+                                                                  name='rnngsn_f_noise'))
         # Sampling functions
         log.maybeLog(self.logger, "Creating sampling function...")
         if self.gsn_layers == 1: 
-            self.f_sample = theano.function(inputs = [X_sample],
-                                            outputs = visible_pX_chain[-1],
-                                            name='rnngsn_f_sample_single_layer')
+            self.register_function('f_sample', lambda: theano.function(inputs = [X_sample],
+                                                                       outputs = visible_pX_chain[-1],
+                                                                       name='rnngsn_f_sample_single_layer'))
         else:
             # WHY IS THERE A WARNING????
             # because the first odd layers are not used -> directly computed FROM THE EVEN layers
             # unused input = warn
-            self.f_sample = theano.function(inputs = self.network_state_input,
-                                            outputs = self.network_state_output + visible_pX_chain,
-                                            on_unused_input='warn',
-                                            name='rnngsn_f_sample')
-         
+            self.register_function('f_sample', lambda: theano.function(inputs = self.network_state_input,
+                                                                       outputs = self.network_state_output + visible_pX_chain,
+                                                                       on_unused_input='warn',
+                                                                       name='rnngsn_f_sample'))
     
-        log.maybeLog(self.logger, "Done compiling all functions.")
-        compilation_time = time.time() - start_functions_time
-        # Show the compile time with appropriate easy-to-read units.
-        log.maybeLog(self.logger, "Total compilation time took "+make_time_units_string(compilation_time)+".\n\n")
+        log.maybeLog(self.logger, "Done building all graphs - functions will be compiled on first use.\n\n")
+    
+    def load_resident_splits(self, splits):
+        """
+        Uploads the shared datasets of all the splits into the data buffer once, one after the other, so training
+        only passes offsets and minibatch indices and the data stays on the device.
+        
+        @rtype:   List
+        @return:  the (start, length) span of each split in the data buffer
+        """
+        values = [dataset.get_value(borrow=True) for dataset in splits]
+        starts = numpy.concatenate([[0], numpy.cumsum([len(v) for v in values])])
+        self.data_buffer.set_value(numpy.concatenate(values).astype('float32'), borrow=True)
+        return [(int(start), len(v)) for start, v in zip(starts, values)]
+    
+    def apply_to_span(self, function, span):
+        """
+        Applies the (offset, index)-taking function to each minibatch of the dataset at span in the data buffer.
+        """
+        start, length = span
+        return data.apply_indexed_cost_function_to_dataset(lambda i: function(start, i), length, self.batch_size)
       
         
         
@@ -556,6 +579,9 @@ class SEN():
             
             if self.vis_init:
                 self.bias_list[0].set_value(logit(numpy.clip(0.9,0.001,train_X.get_value().mean(axis=0))))
+            
+            # all splits go into the data buffer once - each epoch only passes offsets and indices
+            train_span, valid_span, test_span = self.load_resident_splits([train_X, valid_X, test_X])
         
             while not STOP:
                 counter += 1
@@ -564,21 +590,23 @@ class SEN():
                     
                 if is_artificial:
                     data.sequence_mnist_data(train_X, train_Y, valid_X, valid_Y, test_X, test_Y, artificial_sequence, rng)
+                    # the datasets were reordered, so upload them again
+                    train_span, valid_span, test_span = self.load_resident_splits([train_X, valid_X, test_X])
                      
                 #train
-                train_costs = data.apply_cost_function_to_dataset(self.f_learn, train_X, self.batch_size)
+                train_costs = self.apply_to_span(self.f_learn, train_span)
                 # record it
                 log.maybeAppend(self.logger, ['Train:',trunc(train_costs),'\t'])
          
          
                 #valid
-                valid_costs = data.apply_cost_function_to_dataset(self.f_cost, valid_X, self.batch_size)
+                valid_costs = self.apply_to_span(self.f_cost, valid_span)
                 # record it
                 log.maybeAppend(self.logger, ['Valid:',trunc(valid_costs), '\t'])
          
          
                 #test
-                test_costs = data.apply_cost_function_to_dataset(self.f_cost, test_X, self.batch_size)
+                test_costs = self.apply_to_span(self.f_cost, test_span)
                 # record it 
                 log.maybeAppend(self.logger, ['Test:',trunc(test_costs), '\t'])
                  
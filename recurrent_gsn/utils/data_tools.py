@@ -8,10 +8,10 @@ https://github.com/yaoli/GSN
 import numpy
 import theano
 import theano.tensor as T
-import os, cPickle, gzip, errno, urllib, glob, zipfile
+import os, cPickle, gzip, errno, urllib, glob, zipfile, hashlib, multiprocessing
 from utils import cast32
 import scipy.io as io
-from midi.utils import midiread
+from midi.utils import read_piano_roll
 
 # Define the re-used loops for f_learn and f_cost
 def apply_cost_function_to_dataset(function, dataset, batch_size=1):
@@ -54,54 +54,245 @@ def download_mnist(path):
     filename = 'mnist.pkl.gz'
     download_file(origin, path, filename)
     
-def download_piano_midi_de(path):
+def download_piano_midi_de(path, extract=True):
     origin = 'http://www-etud.iro.umontreal.ca/~boulanni/Piano-midi.de.zip'
     filename = 'Piano-midi.de.zip'
     download_file(origin, path, filename)
-    unzip(os.path.join(path, filename), path)
+    if extract:
+        unzip(os.path.join(path, filename), path)
 
-def download_nottingham(path):
+def download_nottingham(path, extract=True):
     origin = 'http://www-etud.iro.umontreal.ca/~boulanni/Nottingham.zip'
     filename = 'Nottingham.zip'
     download_file(origin, path, filename)
-    unzip(os.path.join(path, filename), path)
+    if extract:
+        unzip(os.path.join(path, filename), path)
     
-def download_muse(path):
+def download_muse(path, extract=True):
     origin = 'http://www-etud.iro.umontreal.ca/~boulanni/MuseData.zip'
     filename = 'MuseData.zip'
     download_file(origin, path, filename)
-    unzip(os.path.join(path, filename), path)
+    if extract:
+        unzip(os.path.join(path, filename), path)
     
-def download_jsb(path):
+def download_jsb(path, extract=True):
     origin = 'http://www-etud.iro.umontreal.ca/~boulanni/JSB%20Chorales.zip'
     filename = 'JSB Chorales.zip'
     download_file(origin, path, filename)
-    unzip(os.path.join(path, filename), path)
+    if extract:
+        unzip(os.path.join(path, filename), path)
 
-def load_mnist(path):
-    ''' Loads the mnist dataset
-
-    :type path: string
-    :param dataset: the path to the directory containing MNIST
+class PackedBinaryDataset(object):
     '''
-    mkdir_p(path)
+    A binary (0/1) dataset stored with 1 bit per value (numpy.packbits along the rows).
+    Slicing unpacks just the requested rows to float32, so minibatches are unpacked right before they are used.
+    get_value() unpacks the whole dataset, so code written for shared datasets can read it the same way.
+    '''
+    def __init__(self, X):
+        X = numpy.asarray(X)
+        self.n_features = X.shape[1]
+        self.packed = numpy.packbits(X != 0, axis=1)
+        self.shape = X.shape
     
-    pkl_file = os.path.join(path,'mnist.pkl')
-    gzip_file = os.path.join(path,'mnist.pkl.gz')
+    def __len__(self):
+        return self.shape[0]
     
-    #check if a pkl or gz file exists
-    if os.path.isfile(pkl_file):
-        data = cPickle.load(open(pkl_file, 'r'))
-    elif os.path.isfile(gzip_file):
-        data = cPickle.load(gzip.open(gzip_file, 'rb'))
-    else: #otherwise, it doesn't exist - download from lisa lab
-        download_mnist(path)
-        # Load the dataset
-        data = cPickle.load(gzip.open(gzip_file, 'rb'))
+    def __getitem__(self, key):
+        rows = self.packed[key]
+        if rows.ndim == 1:
+            return numpy.unpackbits(rows)[:self.n_features].astype('float32')
+        return numpy.unpackbits(rows, axis=1)[:, :self.n_features].astype('float32')
     
-    return data
+    def get_value(self, borrow=False):
+        return self[:]
 
-def load_mnist_binary(path):
+class SequenceDataset(object):
+    '''
+    A ragged set of sequences (i.e. the piano rolls of a MIDI corpus) stored in one contiguous buffer.
+    Sequence i is data[offsets[i]:offsets[i+1]]. Sequences, windows and subsequences are views into the buffer.
+    get_value() returns the buffer, so code written for shared datasets can read it the same way.
+    An empty split has no sequence to take the width from, so it uses n_features (0 if not given).
+    '''
+    def __init__(self, sequences, dtype=theano.config.floatX, n_features=None):
+        sequences = [numpy.asarray(sequence) for sequence in sequences]
+        lengths = [len(sequence) for sequence in sequences]
+        if n_features is None:
+            n_features = sequences[0].shape[1] if len(sequences) > 0 else 0
+        self.offsets = numpy.concatenate([[0], numpy.cumsum(lengths)]).astype('int64')
+        self.data = numpy.empty((self.offsets[-1], n_features), dtype=dtype)
+        for sequence, start in zip(sequences, self.offsets[:-1]):
+            self.data[start:start+len(sequence)] = sequence
+        self.shape = self.data.shape
+    
+    @property
+    def lengths(self):
+        return numpy.diff(self.offsets)
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]]
+    
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+    
+    def window(self, i, start, length):
+        # rows start:start+length of sequence i, clipped to the sequence
+        start = self.offsets[i] + start
+        return self.data[start:min(start+length, self.offsets[i+1])]
+    
+    def random_subsequence(self, length, rng=numpy.random):
+        # a random window of the given length from a random sequence that is long enough
+        candidates = numpy.flatnonzero(self.lengths >= length)
+        if len(candidates) == 0:
+            raise ValueError("No sequence is at least {0!s} long.".format(length))
+        i = candidates[rng.randint(len(candidates))]
+        return self.window(i, rng.randint(self.lengths[i] - length + 1), length)
+    
+    def spans(self, sort_by_length=False, reverse=False):
+        """
+        Returns the (start, length) of each sequence in the buffer, in order or sorted by length.
+        """
+        order = numpy.arange(len(self))
+        if sort_by_length:
+            order = numpy.argsort(self.lengths, kind='mergesort')
+            if reverse:
+                order = order[::-1]
+        return [(int(self.offsets[i]), int(self.offsets[i+1] - self.offsets[i])) for i in order]
+    
+    def iterate_by_length(self, reverse=False):
+        for start, length in self.spans(sort_by_length=True, reverse=reverse):
+            yield self.data[start:start+length]
+    
+    def padded_batches(self, n_sequences, max_length=None, sort_by_length=True):
+        """
+        Generates (X, mask) batches of n_sequences sequences. X is zero-padded to (time, n_sequences, features)
+        and mask (time, n_sequences) is 1 on the real timesteps. Sorting by length first puts sequences of
+        similar length in the same batch so little is padded. Batches are cut into max_length long chunks.
+        """
+        spans = self.spans(sort_by_length=sort_by_length)
+        for b in xrange(0, len(spans), n_sequences):
+            bucket = spans[b:b+n_sequences]
+            longest = max([length for _, length in bucket])
+            X = numpy.zeros((longest, len(bucket), self.shape[1]), dtype=self.data.dtype)
+            mask = numpy.zeros((longest, len(bucket)), dtype='float32')
+            for j, (start, length) in enumerate(bucket):
+                X[:length, j] = self.data[start:start+length]
+                mask[:length, j] = 1
+            chunk = longest if max_length is None else max_length
+            for t in xrange(0, longest, chunk):
+                yield X[t:t+chunk], mask[t:t+chunk]
+    
+    def get_value(self, borrow=False):
+        return self.data if borrow else self.data.copy()
+
+def dataset_shape(dataset):
+    # packed and sequence datasets know their shape, shared variables have to hand over their value for it
+    if isinstance(dataset, (PackedBinaryDataset, SequenceDataset)):
+        return dataset.shape
+    return dataset.get_value(borrow=True).shape
+
+def dataset_rows(dataset, start, stop):
+    # rows start:stop without unpacking the rest of a packed dataset
+    if isinstance(dataset, PackedBinaryDataset):
+        return dataset[start:stop]
+    return dataset.get_value(borrow=True)[start:stop]
+
+def _read_piano_roll(args):
+    # module level so it can run in the worker processes
+    source, r, dt = args
+    return read_piano_roll(source, r=r, dt=dt, dtype='uint8')
+
+def piano_roll_cache_key(source, r, dt):
+    """
+    Content-addressed key for the piano roll of a MIDI file: the file hash plus the pitch range and time step.
+    source is the filename or the contents of the file (so a zip member and its extracted file share the key).
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            source = f.read()
+    file_hash = hashlib.md5(source).hexdigest()
+    return hashlib.md5(repr((file_hash, tuple(r), dt))).hexdigest()
+
+def midi_sources(path, name, download):
+    """
+    The train, valid and test MIDI files of a dataset: the extracted files under path/name if they exist,
+    otherwise (zip_file, member) pairs of the members of path/name.zip, downloaded first if needed.
+    The members are parsed straight out of the archive instead of being extracted.
+
+    @type  download: Function
+    @param download: The download function of the dataset (i.e. download_nottingham).
+    """
+    splits = ['train', 'valid', 'test']
+    d = os.path.join(path, name)
+    if os.path.isdir(d):
+        return [glob.glob(os.path.join(d, split, '*.mid')) for split in splits]
+    zip_file = os.path.join(path, name+'.zip')
+    if not os.path.isfile(zip_file):
+        download(path, extract=False)
+    with zipfile.ZipFile(zip_file) as zf:
+        members = sorted(zf.namelist())
+    return [[(zip_file, m) for m in members if m.endswith('.mid') and os.path.dirname(m) == name+'/'+split] for split in splits]
+
+def _midi_contents(files):
+    # filenames stay as they are (the parser memory maps them), zip members become buffers with their contents,
+    # reading each archive once
+    sources = list(files)
+    archives = {}
+    for i, f in enumerate(files):
+        if isinstance(f, tuple):
+            archives.setdefault(f[0], []).append(i)
+    for zip_file, indices in archives.items():
+        with zipfile.ZipFile(zip_file) as zf:
+            for i in indices:
+                sources[i] = bytearray(zf.read(files[i][1]))
+    return sources
+
+def load_piano_rolls(files, packed=False, cache_dir=None, r=(21, 109), dt=0.3, processes=None):
+    """
+    Reads the piano rolls of the MIDI files. Files whose roll isn't in cache_dir yet are parsed in a process
+    pool and added to the cache, so a re-run only parses new or changed files.
+
+    @type  files: List
+    @param files: The filenames, or (zip_file, member) pairs to read the files straight from an archive.
+    @type  cache_dir: String
+    @param cache_dir: The directory of the piano roll cache (None to always parse).
+    @type  processes: Integer
+    @param processes: The number of worker processes (defaults to the number of cpus).
+    """
+    sources = _midi_contents(files)
+    rolls = [None] * len(files)
+    filenames = [None] * len(files)
+    if cache_dir is not None:
+        mkdir_p(cache_dir)
+        for i, source in enumerate(sources):
+            filenames[i] = os.path.join(cache_dir, piano_roll_cache_key(source, r, dt)+'.npy')
+            if os.path.isfile(filenames[i]):
+                rolls[i] = numpy.load(filenames[i])
+    
+    missing = [i for i, roll in enumerate(rolls) if roll is None]
+    jobs = [(sources[i], r, dt) for i in missing]
+    if len(jobs) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            parsed = pool.map(_read_piano_roll, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        parsed = [_read_piano_roll(job) for job in jobs]
+    for i, roll in zip(missing, parsed):
+        rolls[i] = roll
+        if cache_dir is not None:
+            _save_npy(filenames[i], roll)
+    
+    if packed:
+        return [PackedBinaryDataset(roll) for roll in rolls]
+    return [roll.astype(theano.config.floatX) for roll in rolls]
+
+def _load_mnist_pickle(path):
     pkl_file = os.path.join(path,'mnist.pkl')
     gzip_file = os.path.join(path,'mnist.pkl.gz')
     
@@ -114,89 +305,104 @@ def load_mnist_binary(path):
         download_mnist(path)
         # Load the dataset
         data = cPickle.load(gzip.open(gzip_file, 'rb'))
-    
-    #make binary
-    data = [list(d) for d in data] 
-    data[0][0] = (data[0][0] > 0.5).astype('float32')
-    data[1][0] = (data[1][0] > 0.5).astype('float32')
-    data[2][0] = (data[2][0] > 0.5).astype('float32')
-    data = tuple([tuple(d) for d in data])
     return data
 
-def load_piano_midi_de(path):
+def _save_npy(filename, array):
+    # write to a temporary file and rename, so concurrent runs never map a partially written array
+    tmp_file = '{0!s}.{1!s}.tmp'.format(filename, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        numpy.save(f, array)
+    os.rename(tmp_file, filename)
+
+def _load_mnist_cached(path, binary):
+    """
+    Loads the mnist splits from the .npy cache under path/mnist_cache, creating it from mnist.pkl(.gz) the
+    first time. The arrays are memory-mapped copy-on-write, so concurrent processes share the same pages.
+    """
+    cache_dir = os.path.join(path, 'mnist_cache')
+    prefix = 'mnist_binary' if binary else 'mnist'
+    splits = ['train', 'valid', 'test']
+    filenames = [[os.path.join(cache_dir, '{0!s}_{1!s}_{2!s}.npy'.format(prefix, split, xy)) for xy in ['X', 'Y']] for split in splits]
+    
+    if not all([os.path.isfile(f) for split_files in filenames for f in split_files]):
+        mkdir_p(cache_dir)
+        data = _load_mnist_pickle(path)
+        for (x, y), (x_file, y_file) in zip(data, filenames):
+            if binary:
+                x = (x > 0.5).astype('float32')
+            _save_npy(x_file, x)
+            _save_npy(y_file, y)
+    
+    return tuple([tuple([numpy.load(f, mmap_mode='c') for f in split_files]) for split_files in filenames])
+
+def load_mnist(path, cache=True):
+    ''' Loads the mnist dataset
+
+    :type path: string
+    :param dataset: the path to the directory containing MNIST
+
+    :type cache: bool
+    :param cache: whether to memory-map the splits from a .npy cache instead of unpickling mnist.pkl.gz
+    '''
     mkdir_p(path)
-    d = os.path.join(path,'Piano-midi.de')
-    if not os.path.isdir(d):
-        download_piano_midi_de(path)
-    
-    train_filenames = os.path.join(path, 'Piano-midi.de', 'train', '*.mid')
-    valid_filenames = os.path.join(path, 'Piano-midi.de', 'valid', '*.mid')
-    test_filenames = os.path.join(path, 'Piano-midi.de', 'test', '*.mid')
-    train_files = glob.glob(train_filenames)
-    valid_files = glob.glob(valid_filenames)
-    test_files = glob.glob(test_filenames)
+    if cache:
+        return _load_mnist_cached(path, binary=False)
+    return _load_mnist_pickle(path)
+
+def load_mnist_binary(path, cache=True, packed=False):
+    mkdir_p(path)
+    if cache:
+        data = _load_mnist_cached(path, binary=True)
+    else:
+        data = _load_mnist_pickle(path)
+        #make binary
+        data = [list(d) for d in data] 
+        data[0][0] = (data[0][0] > 0.5).astype('float32')
+        data[1][0] = (data[1][0] > 0.5).astype('float32')
+        data[2][0] = (data[2][0] > 0.5).astype('float32')
+        data = tuple([tuple(d) for d in data])
+    if packed:
+        data = tuple([(PackedBinaryDataset(x), y) for (x, y) in data])
+    return data
+
+def load_piano_midi_de(path, packed=False):
+    mkdir_p(path)
+    train_files, valid_files, test_files = midi_sources(path, 'Piano-midi.de', download_piano_midi_de)
     
-    train_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in train_files]
-    valid_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in valid_files]
-    test_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in test_files]
+    train_datasets = load_piano_rolls(train_files, packed, os.path.join(path, 'piano_roll_cache'))
+    valid_datasets = load_piano_rolls(valid_files, packed, os.path.join(path, 'piano_roll_cache'))
+    test_datasets = load_piano_rolls(test_files, packed, os.path.join(path, 'piano_roll_cache'))
     
     return (train_datasets,[None]), (valid_datasets,[None]), (test_datasets,[None])
     
 
-def load_nottingham(path):
+def load_nottingham(path, packed=False):
     mkdir_p(path)
-    d = os.path.join(path,'Nottingham')
-    if not os.path.isdir(d):
-        download_nottingham(path)
+    train_files, valid_files, test_files = midi_sources(path, 'Nottingham', download_nottingham)
     
-    train_filenames = os.path.join(path, 'Nottingham', 'train', '*.mid')
-    valid_filenames = os.path.join(path, 'Nottingham', 'valid', '*.mid')
-    test_filenames = os.path.join(path, 'Nottingham', 'test', '*.mid')
-    train_files = glob.glob(train_filenames)
-    valid_files = glob.glob(valid_filenames)
-    test_files = glob.glob(test_filenames)
-    
-    train_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in train_files]
-    valid_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in valid_files]
-    test_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in test_files]
+    train_datasets = load_piano_rolls(train_files, packed, os.path.join(path, 'piano_roll_cache'))
+    valid_datasets = load_piano_rolls(valid_files, packed, os.path.join(path, 'piano_roll_cache'))
+    test_datasets = load_piano_rolls(test_files, packed, os.path.join(path, 'piano_roll_cache'))
     
     return (train_datasets,[None]), (valid_datasets,[None]), (test_datasets,[None])
 
-def load_muse(path):
+def load_muse(path, packed=False):
     mkdir_p(path)
-    d = os.path.join(path,'MuseData')
-    if not os.path.isdir(d):
-        download_muse(path)
-    
-    train_filenames = os.path.join(path, 'MuseData', 'train', '*.mid')
-    valid_filenames = os.path.join(path, 'MuseData', 'valid', '*.mid')
-    test_filenames = os.path.join(path, 'MuseData', 'test', '*.mid')
-    train_files = glob.glob(train_filenames)
-    valid_files = glob.glob(valid_filenames)
-    test_files = glob.glob(test_filenames)
+    train_files, valid_files, test_files = midi_sources(path, 'MuseData', download_muse)
     
-    train_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in train_files]
-    valid_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in valid_files]
-    test_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in test_files]
+    train_datasets = load_piano_rolls(train_files, packed, os.path.join(path, 'piano_roll_cache'))
+    valid_datasets = load_piano_rolls(valid_files, packed, os.path.join(path, 'piano_roll_cache'))
+    test_datasets = load_piano_rolls(test_files, packed, os.path.join(path, 'piano_roll_cache'))
     
     return (train_datasets,[None]), (valid_datasets,[None]), (test_datasets,[None])
 
-def load_jsb(path):
+def load_jsb(path, packed=False):
     mkdir_p(path)
-    d = os.path.join(path,'JSB Chorales')
-    if not os.path.isdir(d):
-        download_jsb(path)
-    
-    train_filenames = os.path.join(path, 'JSB Chorales', 'train', '*.mid')
-    valid_filenames = os.path.join(path, 'JSB Chorales', 'valid', '*.mid')
-    test_filenames = os.path.join(path, 'JSB Chorales', 'test', '*.mid')
-    train_files = glob.glob(train_filenames)
-    valid_files = glob.glob(valid_filenames)
-    test_files = glob.glob(test_filenames)
+    train_files, valid_files, test_files = midi_sources(path, 'JSB Chorales', download_jsb)
     
-    train_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in train_files]
-    valid_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in valid_files]
-    test_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in test_files]
+    train_datasets = load_piano_rolls(train_files, packed, os.path.join(path, 'piano_roll_cache'))
+    valid_datasets = load_piano_rolls(valid_files, packed, os.path.join(path, 'piano_roll_cache'))
+    test_datasets = load_piano_rolls(test_files, packed, os.path.join(path, 'piano_roll_cache'))
     
     return (train_datasets,[None]), (valid_datasets,[None]), (test_datasets,[None])
     
@@ -217,7 +423,7 @@ def load_tfd(path):
 
 
 
-def load_datasets(dataset, data_path):
+def load_datasets(dataset, data_path, packed=False):
     """
     Load the appropriate dataset as (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) tuples.
 
@@ -225,6 +431,8 @@ def load_datasets(dataset, data_path):
     @param dataset: Name of the dataset to return.
     @type  data_path: String
     @param data_path: Location of the data directory to use.
+    @type  packed: Boolean
+    @param packed: Whether to return the binary datasets (mnist_binary and the MIDI piano rolls) bit-packed.
     
     @rtype:  Tuples
     @return: (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y)
@@ -232,7 +440,7 @@ def load_datasets(dataset, data_path):
     dataset = dataset.lower()
     if dataset.startswith("mnist"):
         if dataset == "mnist_binary":
-            return load_mnist_binary(data_path)
+            return load_mnist_binary(data_path, packed=packed)
         else:
             (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = load_mnist(data_path)
             try:
@@ -243,13 +451,13 @@ def load_datasets(dataset, data_path):
     elif dataset == "tfd":
         return load_tfd(data_path)
     elif dataset == "nottingham":
-        return load_nottingham(data_path)
+        return load_nottingham(data_path, packed)
     elif dataset == "muse":
-        return load_muse(data_path)
+        return load_muse(data_path, packed)
     elif dataset == "pianomidi":
-        return load_piano_midi_de(data_path)
+        return load_piano_midi_de(data_path, packed)
     elif dataset == "jsb":
-        return load_jsb(data_path)
+        return load_jsb(data_path, packed)
     else:
         raise NotImplementedError("You requested to load dataset {0!s}, please choose MNIST*, TFD, nottingham, muse, pianomidi, jsb.".format(dataset))
 
@@ -0,0 +1,168 @@
+'''
+@author: Markus Beissinger
+University of Pennsylvania, 2014-2015
+
+A persistent on-disk cache for compiled theano functions.
+
+Compiled functions are pickled to the cache directory, keyed by a hash of the model hyperparameters that
+determine the graph (layers, sizes, walkbacks, activations, cost, noise flags...) and of a printout of the
+symbolic graph itself, so changes to the code that builds the graph invalidate the entry too. On a later
+run with the same configuration and graph the optimized graph is unpickled instead of being optimized
+again. When either changes, the old entries for that function no longer match the key and are removed.
+
+An unpickled function comes with its own copies of the shared variables it was compiled with (weights,
+learning rate, random states...). They are swapped for the model's shared variables (checked by name,
+type and shape), so the cached functions update and read the same parameters as freshly compiled ones would.
+Shared variables that hold the dataset (data_names) are pickled empty and their shape isn't checked, so the
+cache doesn't keep a copy of the training data and works for any dataset.
+'''
+
+import os
+import glob
+import cPickle
+import hashlib
+import time
+
+import numpy
+import theano
+from theano.compile import SharedVariable
+from theano.gof import graph
+
+import logger as log
+from utils import make_time_units_string
+
+
+def _graph_variables(outputs, updates, givens=None):
+    # All the variables the compiled function depends on: outputs, updated variables and their updates, givens.
+    variables = list(outputs)
+    if updates is not None:
+        pairs = updates.items() if hasattr(updates, 'items') else updates
+        for shared, update in pairs:
+            variables.append(shared)
+            variables.append(update)
+    if givens is not None:
+        # i.e. the dataset a minibatch index slices
+        pairs = givens.items() if hasattr(givens, 'items') else givens
+        for var, replacement in pairs:
+            variables.append(var)
+            variables.append(replacement)
+    return variables
+
+def _shared_inputs(variables):
+    # The shared variables used by a graph, in a deterministic order (the order of the graph traversal).
+    # Building the same graph with the same configuration gives the same order every run.
+    shared_inputs = []
+    for var in graph.inputs(variables):
+        if isinstance(var, SharedVariable) and var not in shared_inputs:
+            shared_inputs.append(var)
+    return shared_inputs
+
+def _graph_fingerprint(variables):
+    # A hash of the printout of the symbolic graph (ops, types and variable names, including scan inner graphs).
+    # The ids in the printout are assigned in traversal order, so the same graph gives the same printout.
+    printout = theano.printing.debugprint(variables, file='str', ids='CHAR', print_type=True)
+    return hashlib.md5(printout).hexdigest()
+
+def _describe_shared(variables, data_names=()):
+    # the data variables change shape with the dataset, so only their name and type have to match
+    return [(var.name, str(var.type)) + (() if var.name in data_names else (var.get_value(borrow=True).shape,))
+            for var in variables]
+
+
+class FunctionCache(object):
+    '''
+    Compiles theano functions through a persistent cache in cache_dir.
+    '''
+    def __init__(self, cache_dir, config, logger=None, data_names=()):
+        """
+        @type  cache_dir: String
+        @param cache_dir: The directory to store the compiled functions in (i.e. under the model's output path).
+
+        @type  config: Dictionary
+        @param config: The hyperparameters that determine the compiled graphs. Values must have a stable repr.
+
+        @type  data_names: List
+        @param data_names: The names of the shared variables that hold the dataset (i.e. 'data_buffer').
+        """
+        self.logger = logger
+        self.data_names = set(data_names)
+        self.cache_dir = cache_dir
+        if self.cache_dir[-1] != '/':
+            self.cache_dir = self.cache_dir+'/'
+        log.mkdir(self.cache_dir)
+        # the theano version and floatX change the compiled code too
+        key_items = sorted(config.items()) + [('theano', theano.__version__), ('floatX', theano.config.floatX)]
+        self.key = hashlib.md5(repr(key_items)).hexdigest()
+
+    def _filename(self, name, key):
+        return self.cache_dir+name+'.'+key+'.pkl'
+
+    def invalidate(self, name=None, key=None):
+        '''
+        Removes the cached entries for the function name (or all functions) that don't match key.
+        '''
+        pattern = (name if name is not None else '*')+'.*.pkl'
+        for filename in glob.glob(self.cache_dir+pattern):
+            if key is None or not filename.endswith('.'+key+'.pkl'):
+                log.maybeLog(self.logger, "Removing stale compiled function "+filename)
+                os.remove(filename)
+
+    def function(self, name, inputs, outputs, updates=None, **kwargs):
+        '''
+        Same arguments as theano.function, plus the name to cache it under. Returns the cached function if
+        one exists for the current configuration, otherwise compiles and stores it.
+        '''
+        single_output = not isinstance(outputs, (list, tuple))
+        variables = _graph_variables([outputs] if single_output else outputs, updates, kwargs.get('givens'))
+        shared_inputs = _shared_inputs(variables)
+        key = hashlib.md5(self.key + _graph_fingerprint(variables)).hexdigest()
+        filename = self._filename(name, key)
+
+        if os.path.isfile(filename):
+            t = time.time()
+            try:
+                # the graph in the pickle is already optimized - don't optimize it again
+                reoptimize = theano.config.reoptimize_unpickled_function
+                theano.config.reoptimize_unpickled_function = False
+                try:
+                    with open(filename, 'rb') as f:
+                        cached_shared, f_cached = cPickle.load(f)
+                finally:
+                    theano.config.reoptimize_unpickled_function = reoptimize
+                n_inputs = len([i for i in f_cached.maker.inputs if not i.implicit])
+                if n_inputs != len(inputs):
+                    raise ValueError("Cached function takes {0!s} inputs, expected {1!s}".format(n_inputs, len(inputs)))
+                cached_description = _describe_shared(cached_shared, self.data_names)
+                description = _describe_shared(shared_inputs, self.data_names)
+                if cached_description != description:
+                    raise ValueError("Cached function uses shared variables {0!s}, expected {1!s}".format(cached_description, description))
+                # link the optimized graph to the model's containers. Function.copy(swap=...) isn't used, its
+                # copy of the graph gives wrong shapes for the scans in these graphs.
+                swap = dict(zip(cached_shared, shared_inputs))
+                f_cached = f_cached.maker.create([swap[i.variable].container if i.variable in swap else i.value
+                                                  for i in f_cached.maker.inputs])
+                f_cached.name = name
+                log.maybeLog(self.logger, "Loaded compiled {0!s} from cache in {1!s}".format(name, make_time_units_string(time.time()-t)))
+                return f_cached
+            except Exception as e:
+                log.maybeLog(self.logger, "Could not load cached {0!s} ({1!s}), compiling instead.".format(name, e))
+                os.remove(filename)
+
+        self.invalidate(name, key)
+        f = theano.function(inputs=inputs, outputs=outputs, updates=updates, name=name, **kwargs)
+        # the data variables go into the pickle empty - their values are the dataset, not part of the function
+        data = [var for var in shared_inputs if var.name in self.data_names]
+        values = [var.get_value(borrow=True) for var in data]
+        try:
+            for var, value in zip(data, values):
+                var.set_value(numpy.zeros((0,)*value.ndim, dtype=value.dtype), borrow=True)
+            with open(filename, 'wb') as fp:
+                cPickle.dump((shared_inputs, f), fp, protocol=cPickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            log.maybeLog(self.logger, "Could not cache compiled {0!s}: {1!s}".format(name, e))
+            if os.path.isfile(filename):
+                os.remove(filename)
+        finally:
+            for var, value in zip(data, values):
+                var.set_value(value, borrow=True)
+        return f
@@ -0,0 +1,78 @@
+'''
+@author: Markus Beissinger
+University of Pennsylvania, 2014-2015
+
+Lazy, on-demand compilation of a model's theano functions.
+
+Models register a builder for each compiled function (f_learn, f_cost, f_recon, ...) instead of compiling
+everything up front. The function is compiled the first time the attribute is accessed, so a process that
+only samples or only evaluates a checkpoint never compiles the training graph. Selected functions can be
+warmed ahead of time in a background thread.
+'''
+
+import threading
+import time
+
+import logger as log
+from utils import make_time_units_string
+
+
+class LazyFunctions:
+    '''
+    Mixin for models whose compiled functions are built on first access.
+    '''
+    def register_function(self, name, builder):
+        """
+        Registers the builder for the compiled function that will be available as self.<name>.
+
+        @type  name: String
+        @param name: The attribute name of the function (i.e. 'f_learn').
+
+        @type  builder: Function
+        @param builder: Takes no arguments and returns the compiled function.
+        """
+        if '_lazy_builders' not in self.__dict__:
+            self.__dict__['_lazy_builders'] = {}
+            self.__dict__['_lazy_lock'] = threading.RLock()
+        self.__dict__.pop(name, None)
+        self._lazy_builders[name] = builder
+
+    def __getattr__(self, name):
+        # only called when the attribute isn't set yet - compile registered functions on first access
+        builders = self.__dict__.get('_lazy_builders')
+        if builders is None or name not in builders:
+            raise AttributeError(name)
+        return self.compile_function(name)
+
+    def compile_function(self, name):
+        with self._lazy_lock:
+            if name not in self.__dict__:
+                logger = self.__dict__.get('logger')
+                log.maybeLog(logger, "Compiling {0!s}...".format(name))
+                t = time.time()
+                self.__dict__[name] = self._lazy_builders[name]()
+                log.maybeLog(logger, "Compiling {0!s} took {1!s}".format(name, make_time_units_string(time.time()-t)))
+            return self.__dict__[name]
+
+    def is_compiled(self, name):
+        return name in self.__dict__
+
+    def warm_functions(self, names=None, background=True):
+        """
+        Compiles the given functions (all registered functions by default) ahead of their first use.
+
+        @type  background: Boolean
+        @param background: Whether to compile in a daemon thread. The thread is returned so it can be joined.
+        """
+        if names is None:
+            names = sorted(self.__dict__.get('_lazy_builders', {}).keys())
+        def warm():
+            for name in names:
+                self.compile_function(name)
+        if not background:
+            warm()
+            return None
+        thread = threading.Thread(target=warm, name='warm_functions')
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -1,6 +1,6 @@
 # -*- coding: ISO-8859-1 -*-
 
-from struct import pack, unpack
+from struct import pack, unpack, Struct
 
 """
 This module contains functions for reading and writing the special data types
@@ -70,7 +70,11 @@ def writeBew(value, length):
     >>> readBew(writeBew(1642193635L, 4))
     1642193635L
     """
-    return pack('>%s' % {1:'B', 2:'H', 4:'L'}[length], value)
+    return _BEW_STRUCTS[length].pack(value)
+
+
+# precompiled big endian formats for writeBew
+_BEW_STRUCTS = {1:Struct('>B'), 2:Struct('>H'), 4:Struct('>L')}
 
 
 
@@ -118,6 +122,13 @@ def varLen(value):
 
 def writeVar(value):
     "Converts an integer to varlength format"
+    # delta times and lengths are nearly always below 2**14 - look those up
+    if 0 <= value < _VAR_TABLE_SIZE:
+        return _VAR_TABLE[value]
+    return _encodeVar(value)
+
+
+def _encodeVar(value):
     sevens = to_n_bits(value, varLen(value))
     for i in range(len(sevens)-1):
         sevens[i] = sevens[i] | 0x80
@@ -144,6 +155,12 @@ def fromBytes(value):
 
 
 
+# the encodings of all 1 and 2 byte varlen values
+_VAR_TABLE_SIZE = 16384
+_VAR_TABLE = [_encodeVar(value) for value in xrange(_VAR_TABLE_SIZE)]
+
+
+
 if __name__ == '__main__':
 
 #    print to7bits(0, 3)
@@ -51,5 +51,10 @@ class MidiInFile:
     def setData(self, data=''):
         "Sets the data from a plain string"
         self.raw_in.setData(data)
+
+
+    def close(self):
+        "Releases the input file"
+        self.raw_in.close()
     
     
@@ -32,6 +32,17 @@ class MidiOutFile(MidiOutStream):
         trk = self._current_track_buffer
         trk.writeVarLen(self.rel_time())
         trk.writeSlice(slc)
+
+
+
+    def event_bytes(self, values):
+        """
+        Writes an event given as a list of byte values, without building 
+        an intermediate string.
+        """
+        trk = self._current_track_buffer
+        trk.writeVarLen(self.rel_time())
+        trk.writeBytes(values)
         
     
     #####################
@@ -44,8 +55,7 @@ class MidiOutFile(MidiOutStream):
         channel: 0-15
         note, velocity: 0-127
         """
-        slc = fromBytes([NOTE_ON + channel, note, velocity])
-        self.event_slice(slc)
+        self.event_bytes([NOTE_ON + channel, note, velocity])
 
 
     def note_off(self, channel=0, note=0x40, velocity=0x40):
@@ -54,8 +64,7 @@ class MidiOutFile(MidiOutStream):
         channel: 0-15
         note, velocity: 0-127
         """
-        slc = fromBytes([NOTE_OFF + channel, note, velocity])
-        self.event_slice(slc)
+        self.event_bytes([NOTE_OFF + channel, note, velocity])
 
 
     def aftertouch(self, channel=0, note=0x40, velocity=0x40):
@@ -64,8 +73,7 @@ class MidiOutFile(MidiOutStream):
         channel: 0-15
         note, velocity: 0-127
         """
-        slc = fromBytes([AFTERTOUCH + channel, note, velocity])
-        self.event_slice(slc)
+        self.event_bytes([AFTERTOUCH + channel, note, velocity])
 
 
     def continuous_controller(self, channel, controller, value):
@@ -74,8 +82,7 @@ class MidiOutFile(MidiOutStream):
         channel: 0-15
         controller, value: 0-127
         """
-        slc = fromBytes([CONTINUOUS_CONTROLLER + channel, controller, value])
-        self.event_slice(slc)
+        self.event_bytes([CONTINUOUS_CONTROLLER + channel, controller, value])
         # These should probably be implemented
         # http://users.argonet.co.uk/users/lenny/midi/tech/spec.html#ctrlnums
 
@@ -86,8 +93,7 @@ class MidiOutFile(MidiOutStream):
         channel: 0-15
         patch: 0-127
         """
-        slc = fromBytes([PATCH_CHANGE + channel, patch])
-        self.event_slice(slc)
+        self.event_bytes([PATCH_CHANGE + channel, patch])
 
 
     def channel_pressure(self, channel, pressure):
@@ -96,8 +102,7 @@ class MidiOutFile(MidiOutStream):
         channel: 0-15
         pressure: 0-127
         """
-        slc = fromBytes([CHANNEL_PRESSURE + channel, pressure])
-        self.event_slice(slc)
+        self.event_bytes([CHANNEL_PRESSURE + channel, pressure])
 
 
     def pitch_bend(self, channel, value):
@@ -108,8 +113,7 @@ class MidiOutFile(MidiOutStream):
         """
         msb = (value>>7) & 0xFF
         lsb = value & 0xFF
-        slc = fromBytes([PITCH_BEND + channel, msb, lsb])
-        self.event_slice(slc)
+        self.event_bytes([PITCH_BEND + channel, msb, lsb])
 
 
 
@@ -140,7 +144,7 @@ class MidiOutFile(MidiOutStream):
         values: 0-15
         """
         value = (msg_type<<4) + values
-        self.event_slice(fromBytes([MIDI_TIME_CODE, value]))
+        self.event_bytes([MIDI_TIME_CODE, value])
 
 
     def song_position_pointer(self, value):
@@ -150,7 +154,7 @@ class MidiOutFile(MidiOutStream):
         """
         lsb = (value & 0x7F)
         msb = (value >> 7) & 0x7F
-        self.event_slice(fromBytes([SONG_POSITION_POINTER, lsb, msb]))
+        self.event_bytes([SONG_POSITION_POINTER, lsb, msb])
 
 
     def song_select(self, songNumber):
@@ -158,7 +162,7 @@ class MidiOutFile(MidiOutStream):
         """
         songNumber: 0-127
         """
-        self.event_slice(fromBytes([SONG_SELECT, songNumber]))
+        self.event_bytes([SONG_SELECT, songNumber])
 
 
     def tuning_request(self):
@@ -231,12 +235,12 @@ class MidiOutFile(MidiOutStream):
         """
         raw = self.raw_out
         raw.writeSlice(TRACK_HEADER)
-        track_data = self._current_track_buffer.getvalue()
+        track_data = self._current_track_buffer
         # wee need to know size of track data.
         eot_slice = writeVar(self.rel_time()) + fromBytes([META_EVENT, END_OF_TRACK, 0])
         raw.writeBew(len(track_data)+len(eot_slice), 4)
-        # then write
-        raw.writeSlice(track_data)
+        # then write (straight from the track's buffer, without a copy to a string)
+        raw.writeSlice(track_data.buffer)
         raw.writeSlice(eot_slice)
         
 
@@ -1,8 +1,9 @@
 # -*- coding: ISO-8859-1 -*-
 
 # standard library imports
+import mmap
 from types import StringType
-from struct import unpack
+from struct import unpack, Struct
 
 # custom import
 from DataTypeConverters import readBew, readVar, varLen
@@ -16,36 +17,63 @@ class RawInstreamFile:
     endianess, and keeps track of the cursor position. The midi parser 
     only reads from this object. Never directly from the file.
     
+    Numbers are unpacked in place at the cursor, so only the event 
+    payloads handed to the parser are copied out of the data.
+    
     """
     
     def __init__(self, infile=''):
         """ 
-        If 'file' is a string we assume it is a path and read from 
+        If 'file' is a string we assume it is a path and memory map 
         that file.
+        If it is a buffer (bytearray, memoryview or buffer, i.e. a zip 
+        member read into memory) we parse it in place.
         If it is a file descriptor we read from the file, but we don't 
         close it.
-        Midi files are usually pretty small, so it should be safe to 
-        copy them into memory.
         """
+        self._mmap = None
         if infile:
             if isinstance(infile, StringType):
                 infile = open(infile, 'rb')
-                self.data = infile.read()
+                self.data = self._map(infile)
                 infile.close()
+            elif isinstance(infile, (bytearray, memoryview, buffer)):
+                self.data = infile
             else:
                 # don't close the f
                 self.data = infile.read()
         else:
             self.data = ''
+        self.length = len(self.data)
         # start at beginning ;-)
         self.cursor = 0
 
 
+    def _map(self, infile):
+        "Memory maps the file, or reads it if it can't be mapped (i.e. it is empty)"
+        try:
+            self._mmap = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._mmap
+        except (ValueError, EnvironmentError):
+            return infile.read()
+
+
+    def close(self):
+        "Releases the memory map of the file"
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+            self.data = ''
+            self.length = 0
+
+
     # setting up data manually
     
     def setData(self, data=''):
         "Sets the data from a string."
+        self.close()
         self.data = data
+        self.length = len(data)
     
     # cursor operations
 
@@ -69,6 +97,10 @@ class RawInstreamFile:
         "Reads the next text slice from the raw data, with length"
         c = self.cursor
         slc = self.data[c:c+length]
+        if isinstance(slc, memoryview):
+            slc = slc.tobytes()
+        elif isinstance(slc, bytearray):
+            slc = str(slc)
         if move_cursor:
             self.moveCursor(length)
         return slc
@@ -79,7 +111,14 @@ class RawInstreamFile:
         Reads n bytes of date from the current cursor position.
         Moves cursor if move_cursor is true
         """
-        return readBew(self.nextSlice(n_bytes, move_cursor))
+        c = self.cursor
+        if c + n_bytes > self.length:
+            # past the end - same result as on the short slice
+            return readBew(self.nextSlice(n_bytes, move_cursor))
+        value = _BEW_STRUCTS[n_bytes].unpack_from(self.data, c)[0]
+        if move_cursor:
+            self.cursor = c + n_bytes
+        return value
 
 
     def readVarLen(self):
@@ -88,12 +127,22 @@ class RawInstreamFile:
         Moves cursor if move_cursor is true
         """
         MAX_VARLEN = 4 # Max value varlen can be
-        var = readVar(self.nextSlice(MAX_VARLEN, 0))
+        data = self.data
+        var = 0
+        for i in xrange(self.cursor, min(self.cursor + MAX_VARLEN, self.length)):
+            byte = _BYTE.unpack_from(data, i)[0]
+            var = (var << 7) + (byte & 0x7F)
+            if not 0x80 & byte: break # stop after last byte
         # only move cursor the actual bytes in varlen
         self.moveCursor(varLen(var))
         return var
 
 
+# big endian words unpacked straight from the data
+_BEW_STRUCTS = {1:Struct('>B'), 2:Struct('>H'), 4:Struct('>L')}
+_BYTE = _BEW_STRUCTS[1]
+
+
 
 if __name__ == '__main__':
 
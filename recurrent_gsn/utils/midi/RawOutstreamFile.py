@@ -4,7 +4,6 @@
 import sys
 from types import StringType
 from struct import unpack
-from cStringIO import StringIO
 
 # custom import
 from DataTypeConverters import writeBew, writeVar, fromBytes
@@ -15,29 +14,41 @@ class RawOutstreamFile:
     
     Writes a midi file to disk.
     
+    The data is collected in a growable bytearray, so appending stays 
+    linear in the size of the output.
+    
     """
 
     def __init__(self, outfile=''):
-        self.buffer = StringIO()
+        self.buffer = bytearray()
         self.outfile = outfile
 
 
+    def __len__(self):
+        return len(self.buffer)
+
+
     # native data reading functions
 
 
     def writeSlice(self, str_slice):
         "Writes the next text slice to the raw data"
-        self.buffer.write(str_slice)
+        self.buffer.extend(str_slice)
+
+
+    def writeBytes(self, values):
+        "Writes a list of byte values to the raw data"
+        self.buffer.extend(values)
         
         
     def writeBew(self, value, length=1):
         "Writes a value to the file as big endian word"
-        self.writeSlice(writeBew(value, length))
+        self.buffer.extend(writeBew(value, length))
 
 
     def writeVarLen(self, value):
         "Writes a variable length word to the file"
-        var = self.writeSlice(writeVar(value))
+        self.buffer.extend(writeVar(value))
 
 
     def write(self):
@@ -45,7 +56,7 @@ class RawOutstreamFile:
         if self.outfile:
             if isinstance(self.outfile, StringType):
                 outfile = open(self.outfile, 'wb')
-                outfile.write(self.getvalue())
+                outfile.write(self.buffer)
                 outfile.close()
             else:
                 self.outfile.write(self.getvalue())
@@ -53,7 +64,7 @@ class RawOutstreamFile:
             sys.stdout.write(self.getvalue())
                 
     def getvalue(self):
-        return self.buffer.getvalue()
+        return str(self.buffer)
 
 
 if __name__ == '__main__':
@@ -5,28 +5,72 @@
 # Implements midiread and midiwrite functions to read/write MIDI files to/from piano-rolls
 
 
-from MidiOutFile import MidiOutFile
 from MidiInFile import MidiInFile
 from MidiOutStream import MidiOutStream
+from RawOutstreamFile import RawOutstreamFile
+from DataTypeConverters import varLen, fromBytes
+from constants import NOTE_ON, NOTE_OFF, PATCH_CHANGE, META_EVENT, END_OF_TRACK, TRACK_HEADER
+
+import array
 
 import numpy
 
 
+_OPEN = float('nan')
+
+
+def piano_roll_from_notes(pitch, start, end, r=(21, 109), dt=0.2, dtype='float64'):
+  """
+  Rasterizes complete notes (arrays of pitch and start/end seconds) into a (time, r[1]-r[0]) piano roll,
+  marking the frames ceil(start/dt) up to ceil(end/dt) of each note.
+  """
+  length = int(numpy.ceil(numpy.max(end) / dt))
+  width = r[1] - r[0]
+  rows_start = numpy.ceil(start / dt).astype('int64')
+  rows_end = numpy.ceil(end / dt).astype('int64')
+  columns = numpy.asarray(pitch, dtype='int64') - r[0]
+  piano_roll = numpy.zeros((length, width), dtype=dtype)
+  if (columns < 0).any() or (columns >= width).any():
+    # python indexing semantics for pitches outside the roll
+    for p, s, e in zip(columns, rows_start, rows_end):
+      piano_roll[s:e, p] = 1
+    return piano_roll
+  # python slicing semantics for the frames: negative ones (notes timed before a tempo change of an earlier
+  # track) count from the end
+  rows_start = numpy.where(rows_start < 0, numpy.maximum(rows_start + length, 0), numpy.minimum(rows_start, length))
+  rows_end = numpy.where(rows_end < 0, numpy.maximum(rows_end + length, 0), numpy.minimum(rows_end, length))
+
+  # the flat index of every frame of every note: its first frame, then one row further for each frame
+  frames = numpy.maximum(rows_end - rows_start, 0)
+  first = numpy.repeat(rows_start * width + columns, frames)
+  frame = numpy.arange(len(first)) - numpy.repeat(numpy.cumsum(frames) - frames, frames)
+  piano_roll.reshape(-1)[first + frame * width] = 1
+  return piano_roll
+
+
 class midiread(MidiOutStream):
-  def __init__(self, filename, r=(21, 109), dt=0.2):
-    self.notes = []
+  def __init__(self, filename, r=(21, 109), dt=0.2, dtype='float64'):
+    # the notes in compact arrays: pitch, start and end (nan while the note is open)
+    self.pitches = array.array('l')
+    self.starts = array.array('d')
+    self.ends = array.array('d')
+    # index of the latest note of each pitch, so note_off doesn't have to search the notes
+    self.last_note = {}
     self._tempo = 500000
     self.beat = 0
     self.time = 0.0
 
     midi_in = MidiInFile(self, filename)
     midi_in.read()
-    self.notes = [n for n in self.notes if n[2] is not None]  # purge incomplete notes
+    midi_in.close()
 
-    length = int(numpy.ceil(max(zip(*self.notes)[2]) / dt))  # create piano-roll
-    self.piano_roll = numpy.zeros((length, r[1]-r[0]))
-    for n in self.notes:
-      self.piano_roll[int(numpy.ceil(n[1]/dt)) : int(numpy.ceil(n[2]/dt)), n[0]-r[0]] = 1
+    pitch = numpy.frombuffer(self.pitches, dtype=numpy.dtype('l')) if len(self.pitches) else numpy.zeros(0, dtype='int64')
+    start = numpy.frombuffer(self.starts, dtype='float64') if len(self.starts) else numpy.zeros(0)
+    end = numpy.frombuffer(self.ends, dtype='float64') if len(self.ends) else numpy.zeros(0)
+    complete = ~numpy.isnan(end)  # purge incomplete notes
+    self.notes = zip(pitch[complete].tolist(), start[complete].tolist(), end[complete].tolist())
+
+    self.piano_roll = piano_roll_from_notes(pitch[complete], start[complete], end[complete], r, dt, dtype)
 
   def abs_time_in_seconds(self):
     return self.time + self._tempo * (self.abs_time() - self.beat) * 1e-6 / self.div
@@ -40,14 +84,16 @@ class midiread(MidiOutStream):
     self.div = division
 
   def note_on(self, channel=0, note=0x40, velocity=0x40):
-    self.notes.append([note, self.abs_time_in_seconds(), None])
+    self.last_note[note] = len(self.pitches)
+    self.pitches.append(note)
+    self.starts.append(self.abs_time_in_seconds())
+    self.ends.append(_OPEN)
 
   def note_off(self, channel=0, note=0x40, velocity=0x40):
-    i = len(self.notes) - 1
-    while i >= 0 and self.notes[i][0] != note:
-      i -= 1
-    if i >= 0 and self.notes[i][2] is None:
-      self.notes[i][2] = self.abs_time_in_seconds()
+    # only the latest note of the pitch can be ended, and only if it is still open
+    i = self.last_note.get(note)
+    if i is not None and self.ends[i] != self.ends[i]:
+      self.ends[i] = self.abs_time_in_seconds()
 
   def sysex_event(*args):
     pass
@@ -56,31 +102,391 @@ class midiread(MidiOutStream):
     pass
 
 
+class _Unsupported(Exception):
+  """Raised by the fast decoder for input it doesn't reproduce midiread on (malformed or unusual files)."""
+  pass
+
+
+def _read_var(data, pos):
+  # same as RawInstreamFile.readVarLen - including moving on by varLen(value) rather than the bytes read
+  value = 0
+  for byte in data[pos:pos+4]:
+    value = (value << 7) + (byte & 0x7F)
+    if not byte & 0x80:
+      break
+  return value, pos + varLen(value)
+
+
+def _read_bew(data, pos, n_bytes):
+  if pos + n_bytes > len(data):
+    raise _Unsupported()
+  value = 0
+  for byte in data[pos:pos+n_bytes]:
+    value = (value << 8) + byte
+  return value
+
+
+# meta events that midiread's parser unpacks with a fixed length (other lengths make it fail)
+_META_LENGTHS = {0x51: [3], 0x54: [5], 0x58: [4], 0x59: [2], 0x00: [1, 2, 4], 0x20: [1, 2, 4], 0x21: [1, 2, 4]}
+# the same as lookup tables: which meta types have fixed lengths, and which (type, length) pairs are allowed
+_FIXED_META = numpy.zeros(256, dtype=bool)
+_META_LENGTH_OK = numpy.zeros((256, 6), dtype=bool)
+for _type, _lengths in _META_LENGTHS.items():
+  _FIXED_META[_type] = True
+  _META_LENGTH_OK[_type, _lengths] = True
+# the channel messages (by high nibble) that the two byte sizing of events without a status byte is right for
+_TWO_BYTE_CHANNEL = numpy.zeros(16, dtype=bool)
+_TWO_BYTE_CHANNEL[[0x8, 0x9, 0xA, 0xB, 0xE]] = True
+
+
+class _Irregular(Exception):
+  """Raised by the vectorized decoder for files it leaves to the event loop (running status over non-channel
+  events, sysex at the end of a track, events running past their track)."""
+  pass
+
+
+def _read_track_loop(data, pos, end, running_status):
+  """
+  Decodes the events of the track at data[pos:end] one at a time, with the same parsing rules as
+  MidiFileParser. Returns the (tick, kind, value) arrays, the position after the last event (past end if
+  the last event runs over it, like in the parser) and the running status.
+  """
+  tick = 0
+  ticks, kinds, values = [], [], []
+  while pos < end:
+    delta, pos = _read_var(data, pos)
+    tick += delta
+    if pos >= len(data):
+      raise _Unsupported()
+    if data[pos] & 0x80:
+      status = running_status = data[pos]
+      pos += 1
+    else:
+      status = running_status
+    if status is None:
+      raise _Unsupported()
+
+    if status == 0xFF:
+      if pos >= len(data):
+        raise _Unsupported()
+      meta_type = data[pos]
+      meta_length, pos = _read_var(data, pos + 1)
+      meta_data = data[pos:pos+meta_length]
+      pos += meta_length
+      if meta_type in _META_LENGTHS and len(meta_data) not in _META_LENGTHS[meta_type]:
+        raise _Unsupported()
+      if meta_type == 0x51:
+        ticks.append(tick)
+        kinds.append(2)
+        values.append((meta_data[0] << 16) + (meta_data[1] << 8) + meta_data[2])
+    elif status == 0xF0:
+      sysex_length, pos = _read_var(data, pos)
+      if sysex_length < 1:
+        raise _Unsupported()
+      pos += sysex_length - 1
+      if pos >= len(data):
+        raise _Unsupported()
+      if data[pos] == 0xF7:
+        pos += 1
+    elif status & 0xF0 == 0xF0:
+      # system common messages - midiread's parser can't dispatch them
+      raise _Unsupported()
+    else:
+      hi_nible = status & 0xF0
+      size = 1 if hi_nible in (0xC0, 0xD0) else 2
+      if pos + size > len(data):
+        raise _Unsupported()
+      if hi_nible == 0x90 or hi_nible == 0x80:
+        ticks.append(tick)
+        kinds.append(1 if (hi_nible == 0x90 and data[pos+1] != 0) else 0)
+        values.append(data[pos])
+      pos += size
+  events = (numpy.array(ticks, dtype='int64'), numpy.array(kinds, dtype='int64'), numpy.array(values, dtype='int64'))
+  return events, pos, running_status
+
+
+def _read_tracks_vectorized(data, raw, pos, n_tracks):
+  """
+  Decodes the events of all tracks (the track chunks from pos on) without a loop over the bytes.
+  The varlen quantity and the size of an event are computed as if an event started at every byte, which gives
+  the position of the next event from every byte (the end of a track leads on to the start of the next one).
+  The event starts are the positions reached from the start of the first track, found by pointer doubling.
+  Events without a status byte are sized as two byte channel messages and checked against their running
+  status afterwards. Files that need the parser's corner cases raise _Irregular.
+  """
+  starts, ends = [], []
+  for _ in xrange(n_tracks):
+    if pos + 8 > len(data):
+      raise _Irregular()
+    length = _read_bew(data, pos + 4, 4)
+    starts.append(pos + 8)
+    ends.append(pos + 8 + length)
+    pos += 8 + length
+  if n_tracks == 0:
+    return []
+  if ends[-1] > len(raw):
+    raise _Irregular()
+  # positions from here on are relative to the first track
+  offset = starts[0]
+  starts = numpy.array(starts, dtype='int64') - offset
+  ends = numpy.array(ends, dtype='int64') - offset
+  n = int(ends[-1])
+  # the tracks plus the bytes after them that the parser may look at, zero padded past the end of the file
+  b = numpy.zeros(n + 16, dtype='int64')
+  following = raw[offset:offset+n+16]
+  b[:len(following)] = following
+
+  # the varlen quantity starting at each byte (up to 4 bytes, like _read_var) and how far the parser moves on
+  m = n + 8
+  low = b & 0x7F
+  more = b >= 0x80
+  value = low[:m]
+  for j in xrange(1, 4):
+    # the value if the quantity goes on to byte j, for the bytes where all earlier bytes have the high bit set
+    value = numpy.where(more[:m], (value << 7) + low[j:m+j], value)
+    more = more[:-1] & more[1:]
+  var_length = 1 + (value > 127) + (value > 16383) + (value > 2097151)
+
+  # the next event from every byte: delta time, optional status byte, then the event body
+  q = numpy.arange(n, dtype='int64') + var_length[:n]
+  status = b[q]
+  explicit = status >= 0x80
+  r = q + explicit
+  next_event = r + 2 - (explicit & ((status >> 4 == 0xC) | (status >> 4 == 0xD)))
+  meta = numpy.flatnonzero(status == 0xFF)
+  meta_length = numpy.minimum(r[meta] + 1, m - 1)
+  next_event[meta] = r[meta] + 1 + var_length[meta_length] + value[meta_length]
+  sysex = numpy.flatnonzero(status == 0xF0)
+  sysex_length = numpy.minimum(r[sysex], m - 1)
+  sysex_end = r[sysex] + var_length[sysex_length] + value[sysex_length] - 1
+  next_event[sysex] = sysex_end + (b[numpy.minimum(sysex_end, len(b) - 1)] == 0xF7)
+
+  # events stop at the end of their track, which leads on to the start of the next track
+  track_end = numpy.empty(n, dtype='int64')
+  track_end.fill(n)
+  for start, end in zip(starts, ends):
+    track_end[start:end] = end
+  jump = numpy.empty(n + 1, dtype='int64')
+  numpy.minimum(next_event, track_end, out=jump[:n])
+  jump[n] = n
+  jump[ends[:-1]] = starts[1:]
+
+  # event starts: with jump = the k-th next event, the k events after the first k known ones are jump of them
+  path = numpy.zeros(1, dtype='int64')
+  while jump[0] < n:
+    path = numpy.append(path, jump[path])
+    jump = jump[jump]
+  is_end = numpy.zeros(n + 1, dtype=bool)
+  is_end[ends] = True
+  events = path[~is_end[path]]
+
+  status, explicit, r, track_end = status[events], explicit[events], r[events], track_end[events]
+  if (next_event[events] > track_end).any():
+    # an event runs past its track
+    raise _Irregular()
+  if ((status >= 0xF1) & (status != 0xFF)).any():
+    raise _Irregular()
+  sysex = status == 0xF0
+  if sysex.any():
+    sysex_length = numpy.minimum(r[sysex], m - 1)
+    sysex_end = r[sysex] + var_length[sysex_length] + value[sysex_length] - 1
+    if (value[sysex_length] < 1).any() or (sysex_end >= track_end[sysex]).any():
+      raise _Irregular()
+  meta = status == 0xFF
+  meta_type = numpy.where(meta, b[r], -1)
+  fixed = meta & _FIXED_META[numpy.maximum(meta_type, 0)]
+  if fixed.any():
+    fixed_length = value[numpy.minimum(r[fixed] + 1, m - 1)]
+    if (fixed_length > 5).any() or not _META_LENGTH_OK[meta_type[fixed], numpy.minimum(fixed_length, 5)].all():
+      raise _Irregular()
+  # running status: the latest status byte, across tracks
+  latest = numpy.maximum.accumulate(numpy.where(explicit, numpy.arange(len(events)), -1))
+  if len(events) and latest[0] < 0:
+    raise _Irregular()
+  hi_nible = status[latest] >> 4
+  if not _TWO_BYTE_CHANNEL[hi_nible[~explicit]].all():
+    raise _Irregular()
+
+  # ticks count from the start of each track
+  track = numpy.searchsorted(starts, events, side='right') - 1
+  ticks = numpy.cumsum(value[events], dtype='int64')
+  ticks -= numpy.append(0, ticks)[numpy.searchsorted(events, starts)][track]
+  is_tempo = meta_type == 0x51
+  keep = is_tempo | (hi_nible == 0x9) | (hi_nible == 0x8)
+  kinds = ((hi_nible == 0x9) & (b[r+1] != 0)).astype('int64')
+  kinds[is_tempo] = 2
+  values = b[r].astype('int64')
+  tempo_data = r[is_tempo] + 1 + var_length[numpy.minimum(r[is_tempo] + 1, m - 1)]
+  values[is_tempo] = (b[tempo_data] << 16) + (b[tempo_data + 1] << 8) + b[tempo_data + 2]
+  split = numpy.searchsorted(events[keep], starts[1:])
+  return zip(numpy.split(ticks[keep], split), numpy.split(kinds[keep], split), numpy.split(values[keep], split))
+
+
+def read_midi_events(data):
+  """
+  Decodes the note and tempo events of a MIDI file (as a string or buffer) into flat arrays, track after track,
+  with the same parsing rules as MidiFileParser (running status kept across tracks, zero velocity
+  note_on as note_off). The tracks are decoded with numpy (_read_tracks_vectorized), files with events it
+  leaves out go through the event loop.
+
+  Returns the division and a list of (tick, kind, value) int64 arrays per track, where kind is
+  0 for note_off, 1 for note_on (value is the pitch) and 2 for tempo (value is us per quarter note).
+  """
+  if not isinstance(data, bytearray):
+    data = bytearray(data)
+  if data[0:4] != bytearray('MThd'):
+    raise TypeError("It is not a valid midi file!")
+  header_size = _read_bew(data, 4, 4)
+  n_tracks = _read_bew(data, 10, 2)
+  division = _read_bew(data, 12, 2)
+  if division == 0:
+    raise _Unsupported()
+  pos = 14 + max(header_size - 6, 0)
+
+  try:
+    return division, _read_tracks_vectorized(data, numpy.frombuffer(data, dtype='uint8'), pos, n_tracks)
+  except _Irregular:
+    pass
+  running_status = None
+  tracks = []
+  for _ in xrange(n_tracks):
+    length = _read_bew(data, pos + 4, 4)
+    pos += 8
+    events, pos, running_status = _read_track_loop(data, pos, pos + length, running_status)
+    tracks.append(events)
+  return division, tracks
+
+
+def read_notes(source):
+  """
+  The complete notes of a MIDI file (a filename, file object or buffer with its contents) as (pitch, start, end)
+  arrays in seconds, computed exactly like midiread:
+  the tempo state carries over from one track to the next, and a note_off ends the latest note of its
+  pitch if that note is still open.
+  """
+  if isinstance(source, str):
+    with open(source, 'rb') as f:
+      source = f.read()
+  elif hasattr(source, 'read'):
+    source = source.read()
+  division, tracks = read_midi_events(source)
+  if not tracks:
+    return numpy.zeros(0, dtype='int64'), numpy.zeros(0), numpy.zeros(0)
+  # the events of all tracks in one stream, since the tempo state carries over from one track to the next
+  ticks, kinds, values = [numpy.concatenate(arrays) for arrays in zip(*tracks)]
+
+  is_tempo = kinds == 2
+  # the tempo state each event is timed with: the one after all earlier tempo events of the stream
+  time, beat, tempo = 0.0, 0, 500000
+  seg_time, seg_beat, seg_tempo = [time], [beat], [tempo]
+  for tick, value in zip(ticks[is_tempo].tolist(), values[is_tempo].tolist()):
+    time = time + tempo * (tick - beat) * 1e-6 / division
+    beat = tick
+    tempo = value
+    seg_time.append(time)
+    seg_beat.append(beat)
+    seg_tempo.append(tempo)
+  notes = ~is_tempo
+  seg = (numpy.cumsum(is_tempo) - is_tempo)[notes]
+  seg_time, seg_beat, seg_tempo = numpy.array(seg_time), numpy.array(seg_beat, dtype='int64'), numpy.array(seg_tempo, dtype='int64')
+  seconds = seg_time[seg] + seg_tempo[seg] * (ticks[notes] - seg_beat[seg]) * 1e-6 / division
+  pitches = values[notes]
+  is_on = kinds[notes] == 1
+
+  # a note_off closes a note exactly when the previous event of the same pitch is a note_on
+  order = numpy.argsort(pitches, kind='mergesort')
+  p, t, on = pitches[order], seconds[order], is_on[order]
+  closes = (p[1:] == p[:-1]) & on[:-1] & ~on[1:]
+  return p[:-1][closes], t[:-1][closes], t[1:][closes]
+
+
+def read_piano_roll(filename, r=(21, 109), dt=0.2, dtype='float64'):
+  """
+  Equivalent of midiread(filename, r, dt, dtype).piano_roll: decodes the events straight into arrays with
+  numpy instead of going through the event dispatcher. Files it can't reproduce midiread on exactly (malformed
+  data or unusual events) go through midiread instead.
+
+  filename can also be a buffer (i.e. a bytearray of a zip member) or a file object.
+  """
+  if hasattr(filename, 'read'):
+    # keep the contents, midiread may need them again
+    filename = bytearray(filename.read())
+  try:
+    pitch, start, end = read_notes(filename)
+  except _Unsupported:
+    return midiread(filename, r, dt, dtype).piano_roll
+  if len(pitch) == 0:
+    return midiread(filename, r, dt, dtype).piano_roll
+  return piano_roll_from_notes(pitch, start, end, r, dt, dtype)
+
+
+def encode_var_lengths(values):
+  """
+  Encodes an array of non-negative integers in the MIDI variable length format in one go (like
+  DataTypeConverters.writeVar for each value).
+
+  Returns the encoded bytes (uint8) of all values concatenated, and the number of bytes of each value.
+  """
+  values = numpy.asarray(values, dtype='int64')
+  lengths = 1 + (values > 127) + (values > 16383) + (values > 2097151)
+  ends = numpy.cumsum(lengths)
+  encoded = numpy.zeros(ends[-1] if len(ends) else 0, dtype='uint8')
+  # byte j from the end of each value holds bits 7j..7j+6, with the continuation bit on all but the last byte
+  for j in xrange(4):
+    has_byte = lengths > j
+    byte = (values[has_byte] >> (7*j)) & 0x7F
+    if j > 0:
+      byte |= 0x80
+    encoded[ends[has_byte] - 1 - j] = byte
+  return encoded, lengths
+
+
 def midiwrite(filename, piano_roll, r=(21, 109), dt=0.2, patch=0):
-  midi = MidiOutFile(filename)
-  midi.header(division=100)
-  midi.start_of_track() 
-  midi.patch_change(channel=0, patch=patch)
-  t = 0
-  samples = [i.nonzero()[0] + r[0] for i in piano_roll]
-
-  for i in xrange(len(samples)):
-    for f in samples[i]:
-      if i==0 or f not in samples[i-1]:
-        midi.update_time(t)
-        midi.note_on(channel=0, note=f, velocity=90)
-        t = 0
-    
-    t += int(dt*200)
-
-    for f in samples[i]:
-      if i==len(samples)-1 or f not in samples[i+1]:
-        midi.update_time(t)
-        midi.note_off(channel=0, note=f, velocity=0)
-        t = 0
-      
-  midi.update_time(0)
-  midi.end_of_track()
-  midi.eof()
+  """
+  Writes a piano roll as a type 0 MIDI file: a note starts on the first frame of each run of non-zero
+  frames of a pitch and ends after the last one (int(dt*200) ticks per frame at division 100).
+  The events are found by diffing the roll along time and encoded into one byte buffer.
+  """
+  active = numpy.asarray(piano_roll) != 0
+  n_frames, n_pitches = active.shape
+  padded = numpy.zeros((n_frames + 2, n_pitches), dtype='int8')
+  padded[1:-1] = active
+  changes = numpy.diff(padded, axis=0)
+  # onsets at the start of frame i, offsets at the end of frame i
+  on_frames, on_pitches = numpy.nonzero(changes[:-1] == 1)
+  off_frames, off_pitches = numpy.nonzero(changes[1:] == -1)
+
+  # within a frame all onsets come first, each group by ascending pitch
+  frames = numpy.concatenate([on_frames, off_frames])
+  kinds = numpy.concatenate([numpy.zeros(len(on_frames), dtype='int64'), numpy.ones(len(off_frames), dtype='int64')])
+  pitches = numpy.concatenate([on_pitches, off_pitches])
+  order = numpy.lexsort((pitches, kinds, frames))
+  frames, kinds, pitches = frames[order], kinds[order], pitches[order]
+
+  step = int(dt*200)
+  ticks = (frames + kinds) * step
+  deltas = numpy.diff(numpy.concatenate([[0], ticks]))
+  var_bytes, var_lengths = encode_var_lengths(deltas)
 
+  # each event is its delta time followed by status, note and velocity
+  n_events = len(deltas)
+  event_ends = numpy.cumsum(var_lengths + 3)
+  events = numpy.zeros(event_ends[-1] if n_events else 0, dtype='uint8')
+  starts = event_ends - var_lengths - 3
+  var_positions = numpy.repeat(starts - (numpy.cumsum(var_lengths) - var_lengths), var_lengths) + numpy.arange(len(var_bytes))
+  events[var_positions] = var_bytes
+  events[event_ends - 3] = numpy.where(kinds == 0, NOTE_ON, NOTE_OFF)
+  events[event_ends - 2] = pitches + r[0]
+  events[event_ends - 1] = numpy.where(kinds == 0, 90, 0)
 
+  track = fromBytes([0, PATCH_CHANGE, patch]) + events.tostring() + fromBytes([0, META_EVENT, END_OF_TRACK, 0])
+  midi = RawOutstreamFile(filename)
+  midi.writeSlice('MThd')
+  midi.writeBew(6, 4)
+  midi.writeBew(0, 2)
+  midi.writeBew(1, 2)
+  midi.writeBew(100, 2)
+  midi.writeSlice(TRACK_HEADER)
+  midi.writeBew(len(track), 4)
+  midi.writeSlice(track)
+  midi.write()
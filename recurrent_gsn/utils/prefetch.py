@@ -0,0 +1,110 @@
+'''
+@author: Markus Beissinger
+University of Pennsylvania, 2014-2015
+
+Background prefetching of minibatches for the training loops.
+
+A Prefetcher runs a minibatch generator in a worker thread and keeps up to buffer_size prepared minibatches
+in a queue, so slicing, shuffling, corruption and sequence window extraction for the next steps overlap with
+the compiled training function of the current step (which spends its time in BLAS, outside the GIL).
+It records how long the training loop waited for data.
+'''
+
+import sys
+import threading
+import Queue
+import time
+
+import numpy
+
+
+# marks the end of the generator in the queue
+_END = object()
+
+
+class Prefetcher(object):
+    '''
+    Iterates over the items of iterable, preparing them in a background thread.
+    '''
+    def __init__(self, iterable, buffer_size=2):
+        """
+        @type  iterable: Iterable
+        @param iterable: The minibatch generator. It is consumed in the worker thread.
+
+        @type  buffer_size: Integer
+        @param buffer_size: The number of minibatches to prepare ahead of the training loop.
+        """
+        self.queue = Queue.Queue(maxsize=max(1, buffer_size))
+        self.wait_time = 0.
+        self.steps = 0
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._fill, args=(iter(iterable),), name='prefetch')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        # don't block forever on a full queue if the consumer went away
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _fill(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put((item, None)):
+                    return
+        except Exception:
+            self._put((None, sys.exc_info()))
+            return
+        self._put((_END, None))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        t = time.time()
+        item, exc_info = self.queue.get()
+        self.wait_time += time.time() - t
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if item is _END:
+            self._stop.set()
+            raise StopIteration
+        self.steps += 1
+        return item
+
+    def mean_wait_time(self):
+        return self.wait_time / max(1, self.steps)
+
+    def close(self):
+        self._stop.set()
+
+
+def minibatches(dataset, batch_size, rng=None, f_noise=None):
+    """
+    Generates the full minibatches of dataset, in order or shuffled.
+
+    @type  dataset: theano shared variable, numpy array or PackedBinaryDataset
+    @param dataset: The examples, one per row. Packed datasets are unpacked one minibatch at a time.
+
+    @type  rng: numpy.random.RandomState
+    @param rng: If given, the minibatches are visited in a random order.
+
+    @type  f_noise: Function
+    @param f_noise: If given, yields (minibatch, f_noise(minibatch)) so the corruption is done in the worker too.
+    """
+    if hasattr(dataset, 'get_value') and not hasattr(dataset, 'packed'):
+        dataset = dataset.get_value(borrow=True)
+    order = numpy.arange(len(dataset) / batch_size)
+    if rng is not None:
+        rng.shuffle(order)
+    for i in order:
+        xs = dataset[i * batch_size : (i+1) * batch_size]
+        if f_noise is not None:
+            yield xs, f_noise(xs)
+        else:
+            yield xs
@@ -62,6 +62,17 @@ def get_activation_function(name):
     else:
         raise NotImplementedError("Did not recognize activation {0!s}, please use tanh, rectifier, or sigmoid".format(name))
 
+def get_numpy_activation_function(name):
+    # numpy counterparts of get_activation_function, for running trained models without theano
+    if name == 'sigmoid':
+        return lambda x : cast32(1. / (1 + numpy.exp(-x)))
+    elif name == 'rectifier':
+        return lambda x : numpy.maximum(cast32(0), x)
+    elif name == 'tanh':
+        return lambda x : numpy.tanh(x)
+    else:
+        raise NotImplementedError("Did not recognize activation {0!s}, please use tanh, rectifier, or sigmoid".format(name))
+
 def get_cost_function(name):
     eps = 1e-6
     if name == 'binary_crossentropy':
@@ -99,20 +110,67 @@ def corrupt_input(IN, p = 0.5, MRG=None):
     IN      =   IN * noise
     return IN
 
+# one stream shared by every graph that doesn't pass its own MRG, instead of a new stream per call
+_default_MRG = None
+
+def get_default_MRG():
+    global _default_MRG
+    if _default_MRG is None:
+        _default_MRG = RNG_MRG.MRG_RandomStreams(1)
+    return _default_MRG
+
 def salt_and_pepper(IN, p = 0.2, MRG=None):
     if MRG is None:
-        MRG = RNG_MRG.MRG_RandomStreams(1)
-    # salt and pepper noise
-    a = MRG.binomial(size=IN.shape, n=1,
-                          p = 1 - p,
-                          dtype='float32')
-    b = MRG.binomial(size=IN.shape, n=1,
-                          p = 0.5,
-                          dtype='float32')
-    c = T.eq(a,0) * b
+        MRG = get_default_MRG()
+    # salt and pepper noise from a single uniform draw:
+    # u >= p keeps the input, u < p/2 sets it to 1, p/2 <= u < p sets it to 0
+    u = MRG.uniform(size=IN.shape, low=0., high=1., dtype='float32')
+    a = T.cast(T.ge(u, p), 'float32')
+    c = T.cast(T.lt(u, p / 2.), 'float32')
     return IN * a + c
 
 
+def sample_chains(f_sample, f_noise, initial, hidden_sizes, n_chains=100, n_steps=100, burn_in=0, thin=1):
+    """
+    Runs n_chains independent GSN sampling chains at once, as the rows of one minibatch through f_sample.
+    f_sample is the compiled one-walkback sampling function: it takes the network state [X, H1, ..., Hk]
+    and returns the new network state followed by the visible p(X|...) chain.
+
+    @type  initial: numpy matrix
+    @param initial: The initial visible state - either one row (shared by every chain) or n_chains rows.
+
+    @type  hidden_sizes: List(int)
+    @param hidden_sizes: The sizes of the hidden layers H1...Hk.
+
+    @type  burn_in: Integer
+    @param burn_in: The number of walkbacks to run before keeping any samples.
+
+    @type  thin: Integer
+    @param thin: Keep one sample every thin walkbacks after the burn in.
+
+    @rtype:   numpy array
+    @return:  visible samples of shape (n_chains, n_steps, input_size)
+    """
+    initial = cast32(initial)
+    if initial.shape[0] == 1:
+        initial = numpy.repeat(initial, n_chains, axis=0)
+    elif initial.shape[0] != n_chains:
+        raise ValueError("Initial state has %d rows but %d chains were requested" % (initial.shape[0], n_chains))
+    
+    network_state = [f_noise(initial)] + [numpy.zeros((n_chains, size), dtype='float32') for size in hidden_sizes]
+    samples = numpy.empty((n_chains, n_steps, initial.shape[1]), dtype='float32')
+    
+    kept = 0
+    walkback = 0
+    while kept < n_steps:
+        out = f_sample(*network_state)
+        network_state = out[:len(network_state)]
+        if walkback >= burn_in and (walkback - burn_in) % thin == 0:
+            samples[:, kept] = out[len(network_state)]
+            kept += 1
+        walkback += 1
+    return samples
+
 def fix_input_size(xs, hiddens=None):
     # Make the dimensions of all X's in xs be the same. (with xs being a list of 2-dimensional matrices)
     sizes = [x.shape[0] for x in xs]